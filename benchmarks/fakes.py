@@ -0,0 +1,263 @@
+"""
+Stand-ins for the hardware and GCS, so the wake cycle can be run and timed on a development machine.
+
+install() puts fake RPi.GPIO, usb.core and serial modules in sys.modules, before anything from src is imported.
+They share one FakeModem, which boots when POWER_ON_N is strobed with the rail on, enumerates on the USB
+bus after boot_delay seconds, answers the AT commands the driver uses and powers down on AT!POWERDOWN.
+
+FakeBucket stores uploads in a local directory, both plain uploads through blob().upload_from_filename()
+and resumable uploads through client._http. Transfers are delayed to model a cellular link, with a
+round trip per request and one shared bandwidth for all streams. Like GCS, an upload sent with an md5Hash
+that doesn't match what arrived is rejected.
+"""
+
+import base64
+import hashlib
+import os
+import shutil
+import sys
+import threading
+import time
+import types
+
+P3V7_EN = 7
+POWER_ON_N = 5
+
+class FakeModem:
+    """ State of the pretend RC7620 shared by the fake GPIO, usb and serial modules """
+    def __init__(self, boot_delay=2.0, shutdown_delay=0.5, link_delay=1.0):
+        self.boot_delay = boot_delay
+        self.shutdown_delay = shutdown_delay
+        self.link_delay = link_delay
+        self.pins = {}
+        self.enumerated_at = None
+        self.gone_at = None
+
+    def pin_changed(self, pin, value):
+        previous = self.pins.get(pin)
+        self.pins[pin] = value
+        # The modem boots on the falling edge of the POWER_ON_N strobe, if the rail is on
+        if pin == POWER_ON_N and previous == 1 and value == 0 and self.pins.get(P3V7_EN) == 1:
+            self.enumerated_at = time.monotonic() + self.boot_delay
+            self.gone_at = None
+        if pin == P3V7_EN and value == 0:
+            self.enumerated_at = None
+
+    def power_down(self):
+        if self.enumerated():
+            self.gone_at = time.monotonic() + self.shutdown_delay
+
+    def enumerated(self):
+        now = time.monotonic()
+        if self.enumerated_at is None or now < self.enumerated_at:
+            return False
+        if self.gone_at is not None and now >= self.gone_at:
+            self.enumerated_at = None
+            return False
+        return True
+
+    def link_up(self):
+        """ True once the network has had link_delay seconds after the modem enumerated """
+        return self.enumerated() and time.monotonic() >= self.enumerated_at + self.link_delay
+
+    def respond(self, command):
+        """ Lines the modem sends back for an AT command """
+        if command == 'AT!POWERDOWN':
+            self.power_down()
+            return ['OK']
+        if command == 'AT+CSQ':
+            return ['+CSQ: 18,99', 'OK']
+        if command == 'AT+CCID?':
+            return ['+CCID: 8944110068234567890', 'OK']
+        if command.startswith('AT'):
+            return ['OK']
+        return ['ERROR']
+
+def _gpio_module(modem):
+    gpio = types.ModuleType('RPi.GPIO')
+    gpio.BCM = 11
+    gpio.OUT = 0
+    gpio.IN = 1
+    gpio.HIGH = 1
+    gpio.LOW = 0
+    functions = {}
+
+    def setup(pin, direction, initial=None):
+        functions[pin] = direction
+        if initial is not None:
+            modem.pin_changed(pin, initial)
+
+    gpio.setmode = lambda mode: None
+    gpio.setwarnings = lambda flag: None
+    gpio.setup = setup
+    gpio.output = modem.pin_changed
+    gpio.input = lambda pin: modem.pins.get(pin, 0)
+    gpio.gpio_function = lambda pin: functions.get(pin, gpio.IN)
+    gpio.cleanup = lambda: functions.clear()
+    return gpio
+
+def _usb_modules(modem):
+    usb = types.ModuleType('usb')
+    core = types.ModuleType('usb.core')
+    core.find = lambda idVendor=None, idProduct=None: object() if modem.enumerated() else None
+    usb.core = core
+    return usb, core
+
+def _serial_module(modem):
+    serial = types.ModuleType('serial')
+
+    class SerialException(Exception):
+        pass
+
+    class Serial:
+        def __init__(self, port, baudrate, timeout=None):
+            if not modem.enumerated():
+                raise SerialException(f'could not open port {port}')
+            self.pending = []
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *args):
+            self.close()
+
+        def write(self, data):
+            for command in data.decode().split('\r\n'):
+                if command:
+                    self.pending.extend(line.encode() + b'\r\n' for line in modem.respond(command))
+
+        def readline(self):
+            return self.pending.pop(0) if self.pending else b''
+
+        def read_all(self):
+            data = b''.join(self.pending)
+            self.pending = []
+            return data
+
+        def reset_input_buffer(self):
+            self.pending = []
+
+        def close(self):
+            pass
+
+    serial.Serial = Serial
+    serial.SerialException = SerialException
+    return serial
+
+def install(modem):
+    """ Put the fake hardware modules in sys.modules """
+    rpi = types.ModuleType('RPi')
+    rpi.GPIO = _gpio_module(modem)
+    usb, core = _usb_modules(modem)
+
+    sys.modules['RPi'] = rpi
+    sys.modules['RPi.GPIO'] = rpi.GPIO
+    sys.modules['usb'] = usb
+    sys.modules['usb.core'] = core
+    sys.modules['serial'] = _serial_module(modem)
+
+class FakeLink:
+    """ A cellular link with a round trip per request and one bandwidth shared by every stream """
+    def __init__(self, rtt=0.3, bandwidth=500 * 1024):
+        self.rtt = rtt
+        self.bandwidth = bandwidth
+        self.lock = threading.Lock()
+        self.free_at = 0
+        self.bytes_sent = 0
+        self.requests = 0
+
+    def transfer(self, nbytes):
+        with self.lock:
+            start = max(time.monotonic(), self.free_at)
+            self.free_at = start + nbytes / self.bandwidth
+            done_at = self.free_at
+            self.bytes_sent += nbytes
+            self.requests += 1
+        time.sleep(self.rtt + max(0, done_at - time.monotonic()))
+
+class FakeResponse:
+    def __init__(self, status_code, headers=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise RuntimeError(f'HTTP {self.status_code}')
+
+def _md5(data):
+    return base64.b64encode(hashlib.md5(data).digest()).decode()
+
+class FakeSession:
+    """ Just enough of the GCS resumable upload protocol for src/resumable.py """
+    def __init__(self, bucket):
+        self.bucket = bucket
+        self.lock = threading.Lock()
+        self.sessions = {}
+
+    def post(self, url, params=None, json=None, headers=None):
+        self.bucket.link.transfer(0)
+        with self.lock:
+            uri = f'fake://session/{len(self.sessions)}'
+            self.sessions[uri] = {'name': json['name'], 'md5': json.get('md5Hash'),
+                                  'size': int(headers['X-Upload-Content-Length']), 'data': bytearray()}
+        return FakeResponse(200, {'Location': uri})
+
+    def put(self, uri, data=None, headers=None):
+        session = self.sessions[uri]
+        received, total = headers['Content-Range'][len('bytes '):].split('/')
+
+        if received != '*':
+            self.bucket.link.transfer(len(data))
+            session['data'] += data
+        else:
+            self.bucket.link.transfer(0)
+
+        if len(session['data']) >= session['size']:
+            if session['md5'] and session['md5'] != _md5(session['data']):
+                return FakeResponse(400)
+            self.bucket.store(session['name'], bytes(session['data']))
+            return FakeResponse(200)
+        if not session['data']:
+            return FakeResponse(308)
+        return FakeResponse(308, {'Range': f"bytes=0-{len(session['data']) - 1}"})
+
+class FakeBlob:
+    def __init__(self, bucket, name):
+        self.bucket = bucket
+        self.name = name
+        self.md5_hash = None
+
+    def upload_from_filename(self, filename):
+        self.bucket.link.transfer(os.path.getsize(filename))
+        with open(filename, 'rb') as f:
+            if self.md5_hash and self.md5_hash != _md5(f.read()):
+                raise RuntimeError('HTTP 400')
+        self.bucket.store_file(self.name, filename)
+
+class FakeBucket:
+    """ Keeps uploaded objects under object_dir """
+    def __init__(self, object_dir, link, name='bucket'):
+        self.name = name
+        self.object_dir = object_dir
+        self.link = link
+        self.client = types.SimpleNamespace(_http=FakeSession(self))
+
+    def blob(self, name):
+        return FakeBlob(self, name)
+
+    def _path(self, name):
+        path = os.path.join(self.object_dir, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        return path
+
+    def store(self, name, data):
+        with open(self._path(name), 'wb') as f:
+            f.write(data)
+
+    def store_file(self, name, filename):
+        shutil.copyfile(filename, self._path(name))
+
+    def objects(self):
+        """ Names of every stored object """
+        return [os.path.relpath(os.path.join(root, f), self.object_dir)
+                for root, _, files in os.walk(self.object_dir) for f in files]
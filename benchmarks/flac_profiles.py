@@ -0,0 +1,105 @@
+"""
+Compression ratio against encoding speed for each FLAC profile in src/encoding.py.
+
+Every profile converts copies of the same recordings, one file at a time, and the output size,
+wall time, CPU time and the CPU time of the encoding alone are reported. The speeds are input MB
+per encoding CPU second, the same measure 'auto' mode keeps in its stats file, so the results can
+be used to seed DEFAULT_STATS.
+
+Uses real AudioMoth recordings if given a directory of WAV files, otherwise a synthetic backlog
+like wake_cycle.py. Needs numpy and soundfile installed. Run from the repository root:
+
+    python benchmarks/flac_profiles.py
+    python benchmarks/flac_profiles.py --input /mnt/x/recordings --profiles fast default best
+"""
+
+import argparse
+import glob
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+
+def benchmark(profile, wav_paths, work_dir, verify):
+    """ Convert copies of wav_paths with profile and return the totals """
+    from src import utils
+
+    copies = []
+    for path in wav_paths:
+        copy = os.path.join(work_dir, os.path.basename(path))
+        shutil.copyfile(path, copy)
+        copies.append(copy)
+
+    input_bytes = sum(os.path.getsize(copy) for copy in copies)
+    output_bytes = 0
+    encode_cpu = 0.0
+    wall_start = time.perf_counter()
+    cpu_start = time.process_time()
+
+    for copy in copies:
+        stats = {}
+        output = utils.wavtoflac(copy, verify=verify, profile=profile, stats=stats)
+        output_bytes += os.path.getsize(output)
+        encode_cpu += stats['encode_cpu_s']
+
+    cpu = time.process_time() - cpu_start
+    wall = time.perf_counter() - wall_start
+    return {
+        'profile': profile,
+        'files': len(copies),
+        'input_mb': input_bytes / 1024 / 1024,
+        'ratio': output_bytes / input_bytes,
+        'wall_s': wall,
+        'cpu_s': cpu,
+        'encode_cpu_s': encode_cpu,
+        'speed_mb_per_cpu_s': input_bytes / 1024 / 1024 / max(encode_cpu, 1e-6),
+    }
+
+def main():
+    sys.path[:0] = [REPO_DIR, os.path.join(REPO_DIR, 'src'), BENCH_DIR]
+    from src import encoding, utils
+    from wake_cycle import generate_backlog
+
+    parser = argparse.ArgumentParser(description='Report compression ratio against encoding speed for each FLAC profile')
+    parser.add_argument('--input', help='directory of WAV recordings to use instead of synthetic ones')
+    parser.add_argument('--profiles', nargs='+', choices=list(encoding.PROFILES), default=list(encoding.PROFILES))
+    parser.add_argument('--files', type=int, default=5, help='synthetic recordings to generate')
+    parser.add_argument('--duration', type=float, default=55, help='seconds per synthetic recording')
+    parser.add_argument('--samplerate', type=int, default=48000)
+    parser.add_argument('--verify', action='store_true', help='include the decode and compare after each file')
+    parser.add_argument('--json', action='store_true', help='print results as JSON lines')
+    args = parser.parse_args()
+
+    # Silence the per file prints of wavtoflac
+    utils.print = lambda *a, **k: None
+
+    with tempfile.TemporaryDirectory() as tmp:
+        if args.input:
+            wav_paths = sorted(glob.glob(os.path.join(args.input, '*.[wW][aA][vV]')))
+            if not wav_paths:
+                parser.error(f'No WAV files in {args.input}')
+        else:
+            wav_paths = generate_backlog(os.path.join(tmp, 'source'), args.files, args.duration, args.samplerate)
+
+        if not args.json:
+            print(f"{'profile':<15} {'files':>5} {'input MB':>8} {'ratio':>6} {'wall s':>7} {'cpu s':>7} {'enc cpu s':>9} {'MB/cpu s':>8}")
+
+        for profile in args.profiles:
+            work_dir = os.path.join(tmp, profile)
+            os.makedirs(work_dir)
+            r = benchmark(profile, wav_paths, work_dir, args.verify)
+            shutil.rmtree(work_dir)
+
+            if args.json:
+                print(json.dumps(r))
+            else:
+                print(f"{r['profile']:<15} {r['files']:>5} {r['input_mb']:>8.1f} {r['ratio']:>6.3f} {r['wall_s']:>7.2f} "
+                      f"{r['cpu_s']:>7.2f} {r['encode_cpu_s']:>9.2f} {r['speed_mb_per_cpu_s']:>8.1f}")
+
+if __name__ == '__main__':
+    main()
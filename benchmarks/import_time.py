@@ -0,0 +1,99 @@
+"""
+Measures the import time of the startup modules and of the subsystems they load lazily, using python -X importtime.
+
+Every boot pays for the startup imports before any work starts, so this is worth checking after adding imports.
+Run from the repository root:
+
+    python benchmarks/import_time.py                          # print the report
+    python benchmarks/import_time.py --save baseline.json     # store the results
+    python benchmarks/import_time.py --baseline baseline.json # exit 1 if anything got slower than the tolerance
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Imported at boot, these should stay cheap
+STARTUP_MODULES = ['src.utils']
+
+# Imported only when their stage runs, measured so we know what each stage costs
+LAZY_MODULES = ['numpy', 'soundfile', 'requests', 'google.cloud.storage', 'drivers.modem']
+
+def import_time(module, repeat):
+    """
+    Import module in a fresh interpreter repeat times.
+
+    Returns:
+        (total_us, imports) - the lowest cumulative import time of module in microseconds and the
+        [(cumulative_us, name)] of everything it imported on that run, or (None, error) if it failed
+    """
+    env = dict(os.environ)
+    # src has to be on the path too, drivers.modem is imported as a top level package
+    env['PYTHONPATH'] = os.pathsep.join([REPO_DIR, os.path.join(REPO_DIR, 'src'), env.get('PYTHONPATH', '')])
+
+    best = None
+    for _ in range(repeat):
+        result = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                                cwd=REPO_DIR, env=env, capture_output=True, text=True)
+        if result.returncode != 0:
+            return None, result.stderr.strip().splitlines()[-1]
+
+        imports = []
+        for line in result.stderr.splitlines():
+            # import time: self [us] | cumulative | imported package
+            if not line.startswith('import time:') or 'cumulative' in line:
+                continue
+            _, cumulative, name = line[len('import time:'):].split('|')
+            imports.append((int(cumulative), name.strip()))
+
+        # The module itself is the last, outermost import
+        total = next(cumulative for (cumulative, name) in reversed(imports) if name == module)
+        if best is None or total < best[0]:
+            best = (total, imports)
+
+    return best
+
+def main():
+    parser = argparse.ArgumentParser(description='Report import time of the startup modules and lazily loaded subsystems')
+    parser.add_argument('--modules', nargs='+', default=STARTUP_MODULES + LAZY_MODULES)
+    parser.add_argument('--repeat', type=int, default=5, help='imports per module, the fastest is reported')
+    parser.add_argument('--top', type=int, default=5, help='slowest imports to list under each module')
+    parser.add_argument('--save', help='write the results to this JSON file')
+    parser.add_argument('--baseline', help='JSON file from --save to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed slowdown against the baseline, 0.2 is 20%%')
+    args = parser.parse_args()
+
+    results = {}
+    for module in args.modules:
+        total, imports = import_time(module, args.repeat)
+        if total is None:
+            print(f'{module:<25} not importable: {imports}')
+            continue
+
+        results[module] = total
+        tag = 'startup' if module in STARTUP_MODULES else 'lazy'
+        print(f'{module:<25} {total / 1000:8.1f} ms  ({tag})')
+        for cumulative, name in sorted(imports, reverse=True)[1:args.top + 1]:
+            print(f'    {name:<40} {cumulative / 1000:8.1f} ms')
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=1)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+        regressions = [module for module, total in results.items()
+                       if module in baseline and total > baseline[module] * (1 + args.tolerance)]
+        for module in regressions:
+            print(f'REGRESSION {module}: {baseline[module] / 1000:.1f} ms -> {results[module] / 1000:.1f} ms')
+        if regressions:
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,193 @@
+"""
+End-to-end benchmark of the wake cycle, run against the stand-ins in fakes.py instead of the modem, GPIO and GCS.
+
+A synthetic AudioMoth backlog is generated, then each stage is run in its own interpreter so the time,
+CPU time and peak RSS reported belong to that stage alone:
+
+    convert  convert_directory on the wav backlog
+    sync     server_sync of an already converted FLAC backlog, including the modem power cycle
+    cycle    the whole main() flow, pipelined or not depending on --no-pipeline
+
+Needs numpy, soundfile and filelock installed. Run from the repository root:
+
+    python benchmarks/wake_cycle.py --files 20 --duration 55
+    python benchmarks/wake_cycle.py --stages convert --workers 1 2 4
+"""
+
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+
+STAGES = ['convert', 'sync', 'cycle']
+
+def generate_backlog(directory, n_files, duration, samplerate, fmt='WAV'):
+    """
+    Write n_files AudioMoth-like recordings: 16 bit mono background noise with a few tonal calls.
+    The files get increasing mtimes, oldest first, like a real backlog.
+    """
+    import numpy as np
+    import soundfile as sf
+
+    os.makedirs(directory, exist_ok=True)
+    rng = np.random.default_rng(0)
+    n_frames = int(duration * samplerate)
+    t = np.arange(n_frames) / samplerate
+    extension = 'wav' if fmt == 'WAV' else 'flac'
+    now = time.time()
+
+    paths = []
+    for n in range(n_files):
+        data = rng.normal(0, 200, n_frames)
+        for start in rng.uniform(0, duration - 1, 5):
+            call = (t >= start) & (t < start + 0.3)
+            data[call] += 4000 * np.sin(2 * np.pi * rng.uniform(2000, 12000) * t[call])
+        path = os.path.join(directory, f'{time.strftime("%Y%m%d", time.gmtime(now))}_{n:06d}.{extension}')
+        sf.write(path, np.clip(data, -32768, 32767).astype('int16'), samplerate, format=fmt, subtype='PCM_16')
+        os.utime(path, (now - (n_files - n) * 60, now - (n_files - n) * 60))
+        paths.append(path)
+    return paths
+
+def peak_rss_mb():
+    """
+    Highest RSS of this process or any of its finished children, in MB.
+    ru_maxrss of this process is carried over from the parent through fork and exec, so it would include the
+    backlog generation. VmHWM is reset on exec, so it only covers this stage's interpreter.
+    """
+    from src.timing import _memory_mb
+
+    _, self_mb = _memory_mb()
+    children_mb = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+    return max(self_mb or 0, children_mb)
+
+def cpu_seconds():
+    usage = [resource.getrusage(who) for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN)]
+    return sum(u.ru_utime + u.ru_stime for u in usage)
+
+def run_stage(args):
+    """ Runs inside the child interpreter: install the fakes, run one stage and print its results as JSON """
+    sys.path[:0] = [REPO_DIR, os.path.join(REPO_DIR, 'src'), BENCH_DIR]
+    import fakes
+
+    hardware = fakes.FakeModem(boot_delay=args.modem_boot, link_delay=args.link_delay)
+    fakes.install(hardware)
+
+    from drivers.modem import Modem
+    from src import utils, telemetry
+
+    usb_dir = os.path.join(args.dir, 'usb')
+    wav_dir = os.path.join(usb_dir, 'recordings')
+    link = fakes.FakeLink(rtt=args.rtt, bandwidth=args.bandwidth * 1024)
+    bucket = fakes.FakeBucket(os.path.join(args.dir, 'bucket'), link)
+
+    # Point the sync at the fakes and the temporary USB
+    utils.usb_dirs = [usb_dir]
+    utils.upload_journal_path = os.path.join(args.dir, 'upload_journal.json')
+    utils.profile_stats_path = os.path.join(args.dir, 'flac_profile_stats.json')
+    utils.get_bucket = lambda credentials_path: bucket
+    utils.check_internet_conn = lambda timeout=2, use_http=False: hardware.link_up()
+    utils.update_time = lambda: None
+    utils.conversion_workers = args.workers
+    utils.upload_workers = args.upload_workers
+    telemetry.TELEMETRY_PATH = os.path.join(args.dir, 'telemetry.csv')
+
+    modem = Modem(lock_file_path=os.path.join(args.dir, 'modem.lock'))
+
+    rss_before = peak_rss_mb()
+    cpu_before = cpu_seconds()
+    start = time.monotonic()
+
+    if args.run_stage == 'convert':
+        utils.convert_directory(wav_dir)
+    elif args.run_stage == 'sync':
+        utils.server_sync(cloud_dir='bench', credentials_path=None, modem=modem)
+    elif args.run_stage == 'cycle':
+        # Same as main.main(), without the log and the shut down
+        if args.pipeline:
+            utils.pipeline_sync(wav_dir, cloud_dir='bench', credentials_path=None, modem=modem)
+        else:
+            new_files = []
+            utils.convert_directory(wav_dir, on_converted=new_files.append)
+            utils.server_sync(cloud_dir='bench', credentials_path=None, modem=modem, new_files=new_files)
+
+    result = {
+        'stage': args.run_stage,
+        'wall_s': time.monotonic() - start,
+        'cpu_s': cpu_seconds() - cpu_before,
+        'rss_before_mb': rss_before,
+        'peak_rss_mb': peak_rss_mb(),
+        'bytes_uploaded': link.bytes_sent,
+        'requests': link.requests,
+        'objects': len(bucket.objects()) if os.path.isdir(bucket.object_dir) else 0,
+    }
+    print('RESULT ' + json.dumps(result))
+
+def benchmark(stage, args, workers):
+    """ Generate the backlog for stage in a temporary directory and run it in a child interpreter """
+    with tempfile.TemporaryDirectory() as tmp:
+        wav_dir = os.path.join(tmp, 'usb', 'recordings')
+        # The newest file is never converted, so make one more than asked for
+        fmt = 'FLAC' if stage == 'sync' else 'WAV'
+        paths = generate_backlog(wav_dir, args.files + (fmt == 'WAV'), args.duration, args.samplerate, fmt)
+        backlog_mb = sum(os.path.getsize(p) for p in paths) / 1024 / 1024
+
+        cmd = [sys.executable, os.path.abspath(__file__), '--run-stage', stage, '--dir', tmp,
+               '--workers', str(workers), '--upload-workers', str(args.upload_workers),
+               '--rtt', str(args.rtt), '--bandwidth', str(args.bandwidth),
+               '--modem-boot', str(args.modem_boot), '--link-delay', str(args.link_delay)]
+        if not args.pipeline:
+            cmd.append('--no-pipeline')
+
+        output = subprocess.run(cmd, capture_output=True, text=True)
+        lines = [line for line in output.stdout.splitlines() if line.startswith('RESULT ')]
+        if output.returncode != 0 or not lines:
+            raise RuntimeError(f'{stage} failed:\n{output.stderr}')
+
+        result = json.loads(lines[-1][len('RESULT '):])
+        result.update(files=args.files, backlog_mb=backlog_mb, workers=workers)
+        return result
+
+def main():
+    parser = argparse.ArgumentParser(description='Time the wake cycle against fake hardware and a fake GCS bucket')
+    parser.add_argument('--stages', nargs='+', choices=STAGES, default=STAGES)
+    parser.add_argument('--files', type=int, default=20, help='recordings in the backlog')
+    parser.add_argument('--duration', type=float, default=55, help='seconds per recording')
+    parser.add_argument('--samplerate', type=int, default=48000)
+    parser.add_argument('--workers', type=int, nargs='+', default=[4], help='conversion workers, each value is run separately')
+    parser.add_argument('--upload-workers', type=int, default=4)
+    parser.add_argument('--rtt', type=float, default=0.3, help='seconds per request on the fake link')
+    parser.add_argument('--bandwidth', type=float, default=500, help='KB/s shared by all uploads on the fake link')
+    parser.add_argument('--modem-boot', type=float, default=2.0, help='seconds from power on to USB enumeration')
+    parser.add_argument('--link-delay', type=float, default=1.0, help='seconds from enumeration to a working connection')
+    parser.add_argument('--no-pipeline', dest='pipeline', action='store_false', help='run the cycle stage without pipeline_sync')
+    parser.add_argument('--json', action='store_true', help='print results as JSON lines')
+    parser.add_argument('--run-stage', choices=STAGES, help=argparse.SUPPRESS)
+    parser.add_argument('--dir', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_stage:
+        args.workers = args.workers[0]
+        run_stage(args)
+        return
+
+    if not args.json:
+        print(f"{'stage':<8} {'workers':>7} {'files':>5} {'backlog MB':>10} {'wall s':>8} {'cpu s':>8} {'peak RSS MB':>11} {'uploaded MB':>11} {'requests':>8}")
+
+    for stage in args.stages:
+        for workers in args.workers:
+            r = benchmark(stage, args, workers)
+            if args.json:
+                print(json.dumps(r))
+            else:
+                print(f"{r['stage']:<8} {r['workers']:>7} {r['files']:>5} {r['backlog_mb']:>10.1f} {r['wall_s']:>8.2f} {r['cpu_s']:>8.2f} "
+                      f"{r['peak_rss_mb']:>11.1f} {r['bytes_uploaded'] / 1024 / 1024:>11.1f} {r['requests']:>8}")
+
+if __name__ == '__main__':
+    main()
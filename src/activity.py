@@ -0,0 +1,163 @@
+"""
+Acoustic activity detection, run on the samples as they're converted so silent audio doesn't have to be encoded or sent.
+
+The audio is cut into frames of FRAME_SECONDS. A frame is active if both its RMS level and the level in
+the band BAND_HZ are above their thresholds, computed for all the frames of a block at once with NumPy.
+Active frames are kept together with PAD_SECONDS of audio either side, so calls aren't clipped.
+
+With trim the gate only passes the kept audio on to the encoder, otherwise it passes everything and
+only records what was active. Either way the kept time ranges are written to a small JSON index next
+to the recording, <name>.activity.json, so the trimmed audio can be lined up with the original times.
+"""
+
+import json
+import os
+from collections import deque
+
+FRAME_SECONDS = 0.5
+
+# Levels in dB relative to full scale. The AudioMoth self noise is around -70 dBFS at medium gain
+RMS_THRESHOLD_DB = -60
+BAND_THRESHOLD_DB = -62
+BAND_HZ = (1000, 20000)
+
+PAD_SECONDS = 1.0
+
+ACTIVITY_SUFFIX = '.activity.json'
+
+def activity_index_path(path):
+    """ Path of the activity index of a recording, from the path of the recording or its FLAC """
+    return os.path.splitext(path)[0] + ACTIVITY_SUFFIX
+
+def frame_levels(frames, samplerate, band=BAND_HZ):
+    """
+    RMS level and band level in dBFS of each frame.
+    frames is an int16 array of shape (frames, samples, channels), the channels are averaged.
+    """
+    import numpy as np
+
+    x = frames.astype('float32').mean(axis=2) / 32768
+    rms_db = 10 * np.log10(np.mean(x * x, axis=1) + 1e-12)
+
+    # Mean square of the band, from the Hann windowed spectrum of each frame
+    window = np.hanning(x.shape[1]).astype('float32')
+    power = np.abs(np.fft.rfft(x * window, axis=1)) ** 2
+    freqs = np.fft.rfftfreq(x.shape[1], 1 / samplerate)
+    in_band = (freqs >= band[0]) & (freqs < band[1])
+    band_ms = 2 * power[:, in_band].sum(axis=1) / (x.shape[1] * np.sum(window * window))
+    band_db = 10 * np.log10(band_ms + 1e-12)
+
+    return rms_db, band_db
+
+class ActivityGate:
+    """
+    Streaming activity detection over int16 blocks of any size.
+    feed() takes each block read from the recording and returns the arrays to encode, finish() returns
+    whatever is still held back at the end. The kept ranges are in self.ranges as [start, end) frame numbers.
+    """
+    def __init__(self, samplerate, channels, trim=True, frame_seconds=FRAME_SECONDS, pad_seconds=PAD_SECONDS,
+                 rms_threshold_db=RMS_THRESHOLD_DB, band_threshold_db=BAND_THRESHOLD_DB, band=BAND_HZ):
+        import numpy as np
+
+        self.samplerate = samplerate
+        self.trim = trim
+        self.frame_length = max(1, int(samplerate * frame_seconds))
+        self.pad_frames = int(round(pad_seconds / frame_seconds))
+        self.rms_threshold_db = rms_threshold_db
+        self.band_threshold_db = band_threshold_db
+        self.band = band
+
+        self.remainder = np.empty((0, channels), dtype='int16')
+        self.preroll = deque(maxlen=self.pad_frames or None)
+        self.hangover = 0
+        self.next_frame = 0
+        self.samples = 0
+        self.ranges = []
+
+    def active(self, frames):
+        """ Boolean array, True for each frame above both thresholds """
+        rms_db, band_db = frame_levels(frames, self.samplerate, self.band)
+        return (rms_db >= self.rms_threshold_db) & (band_db >= self.band_threshold_db)
+
+    def feed(self, block):
+        """ Detect activity in block and return the list of arrays to encode """
+        import numpy as np
+
+        # Copied, the caller reuses its block buffer
+        data = np.concatenate([self.remainder, block])
+        n = len(data) // self.frame_length
+        self.remainder = data[n * self.frame_length:]
+        self.samples += len(block)
+        if not n:
+            return []
+
+        frames = data[:n * self.frame_length].reshape(n, self.frame_length, data.shape[1])
+        return self._gate(frames, self.active(frames))
+
+    def finish(self):
+        """ Detect activity in the last partial frame and return the arrays still to encode """
+        out = []
+        if len(self.remainder):
+            frames = self.remainder.reshape(1, *self.remainder.shape)
+            out = self._gate(frames, self.active(frames))
+        # Anything left in the pre-roll had no activity after it
+        self.preroll.clear()
+        return out
+
+    def _gate(self, frames, active):
+        out = []
+        for frame, is_active in zip(frames, active):
+            index = self.next_frame
+            self.next_frame += 1
+
+            if is_active:
+                while self.preroll:
+                    out.append(self._keep(*self.preroll.popleft()))
+                out.append(self._keep(index, frame))
+                self.hangover = self.pad_frames
+            elif self.hangover:
+                out.append(self._keep(index, frame))
+                self.hangover -= 1
+            elif self.pad_frames:
+                self.preroll.append((index, frame))
+
+        if not self.trim:
+            # Everything is encoded, the pre-roll is only kept for the ranges
+            return list(frames)
+        return out
+
+    def _keep(self, index, frame):
+        """ Add frame number index to the kept ranges and return the frame """
+        if self.ranges and self.ranges[-1][1] == index:
+            self.ranges[-1][1] = index + 1
+        else:
+            self.ranges.append([index, index + 1])
+        return frame
+
+    def kept_seconds(self):
+        """ The kept ranges as [(start, end)] in seconds from the start of the recording """
+        return [(start * self.frame_length / self.samplerate, min(end * self.frame_length, self.samples) / self.samplerate)
+                for start, end in self.ranges]
+
+    def write_index(self, path, source):
+        """ Write the JSON activity index to path. source is the name of the recording """
+        ranges = []
+        output_start = 0.0
+        for start, end in self.kept_seconds():
+            ranges.append({'start': round(start, 3), 'end': round(end, 3), 'output_start': round(output_start, 3) if self.trim else round(start, 3)})
+            output_start += end - start
+
+        index = {
+            'source': source,
+            'samplerate': self.samplerate,
+            'duration_s': round(self.samples / self.samplerate, 3),
+            'kept_s': round(sum(end - start for start, end in self.kept_seconds()), 3),
+            'trimmed': self.trim,
+            'frame_s': self.frame_length / self.samplerate,
+            'rms_threshold_db': self.rms_threshold_db,
+            'band_threshold_db': self.band_threshold_db,
+            'band_hz': list(self.band),
+            'ranges': ranges,
+        }
+        with open(path, 'w') as f:
+            json.dump(index, f)
@@ -0,0 +1,50 @@
+"""
+Replacing a file in one step, so a power cut while it's being written can't leave it half written.
+
+    from .atomic import atomic_write
+
+    with atomic_write(path) as f:
+        json.dump(state, f)
+
+The data goes to a temporary file next to path, which is fsynced and then moved over path. After a
+power cut path holds either the old contents or all of the new ones. With hidden=True the temporary
+file gets a hidden .part name, for directories where every visible file is picked up for upload.
+"""
+
+import os
+from contextlib import contextmanager
+
+def _fsync_dir(directory):
+    """ Make a rename in directory durable. Not every filesystem (e.g. FAT on the USB) allows it, which is fine """
+    try:
+        fd = os.open(directory or '.', os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+@contextmanager
+def atomic_write(path, mode='w', hidden=False, **kwargs):
+    """
+    Open a temporary file for writing in place of path, and move it over path when the with block ends.
+    kwargs are passed to open(). If the block raises, the temporary file is removed and path is left as it was.
+    """
+    directory, name = os.path.split(path)
+    tmp_path = os.path.join(directory, '.' + name + '.part') if hidden else path + '.tmp'
+    try:
+        with open(tmp_path, mode, **kwargs) as f:
+            yield f
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+    _fsync_dir(directory)
@@ -0,0 +1,176 @@
+"""
+Groups small files into tar bundles so they are uploaded as a few objects instead of one request each.
+
+Each bundle is an uncompressed tar (the audio is already FLAC) holding the files under their path
+relative to the USB, plus a MANIFEST.json listing every file with its size, mtime and MD5.
+
+The same module unpacks the bundles on the server side:
+
+    python bundle.py bundle_20240101_1200_0.tar [more bundles...] -o /path/to/project-name
+"""
+
+import argparse
+import base64
+import hashlib
+import io
+import json
+import logging
+import os
+import tarfile
+import time
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+MANIFEST_NAME = 'MANIFEST.json'
+
+# Archives are left as they are, bundling them again only makes them harder to find on the server
+SKIP_SUFFIXES = ('.tar', '.tar.gz')
+
+def _md5(data):
+    """ Base64 MD5, the same format GCS and the upload index use """
+    return base64.b64encode(hashlib.md5(data).digest()).decode()
+
+def plan_bundles(paths, threshold, target_size):
+    """
+    Split paths into groups of files smaller than threshold, each group adding up to at most target_size,
+    and the files that should be uploaded on their own.
+
+    Returns:
+        (groups, others) - a list of lists of paths to bundle, and a list of paths to leave as they are
+    """
+    small = []
+    others = []
+    for path in paths:
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            # Leave it to the uploader to report
+            others.append(path)
+            continue
+
+        if size < threshold and not path.endswith(SKIP_SUFFIXES):
+            small.append((path, size))
+        else:
+            others.append(path)
+
+    groups = []
+    current = []
+    current_size = 0
+    for path, size in small:
+        if current and current_size + size > target_size:
+            groups.append(current)
+            current = []
+            current_size = 0
+        current.append(path)
+        current_size += size
+    if current:
+        groups.append(current)
+
+    # A bundle of a single file only adds overhead
+    for group in groups:
+        if len(group) == 1:
+            others.extend(group)
+
+    return [group for group in groups if len(group) > 1], others
+
+def write_bundle(paths, root, bundle_path):
+    """
+    Write paths into a tar at bundle_path, stored relative to root, followed by the manifest.
+
+    Returns:
+        The manifest, a list of dicts with the path, size, mtime and md5 of each file
+    """
+    # Imported here, so this file still runs on its own for unpacking bundles
+    from .atomic import atomic_write
+
+    manifest = []
+
+    # Written under a hidden temporary name so a half written bundle is never uploaded
+    with atomic_write(bundle_path, 'wb', hidden=True) as f, tarfile.open(fileobj=f, mode='w') as tar:
+        for path in paths:
+            with open(path, 'rb') as f:
+                data = f.read()
+            stat = os.stat(path)
+
+            info = tarfile.TarInfo(os.path.relpath(path, root))
+            info.size = len(data)
+            info.mtime = stat.st_mtime
+            tar.addfile(info, io.BytesIO(data))
+
+            manifest.append({'path': info.name, 'size': len(data), 'mtime': stat.st_mtime, 'md5': _md5(data)})
+
+        data = json.dumps(manifest, indent=1).encode()
+        info = tarfile.TarInfo(MANIFEST_NAME)
+        info.size = len(data)
+        info.mtime = time.time()
+        tar.addfile(info, io.BytesIO(data))
+
+    return manifest
+
+def make_bundles(paths, root, dest_dir, threshold, target_size, prefix='bundle'):
+    """
+    Bundle the small files in paths into tars in dest_dir, named <prefix>_<time>_<n>.tar. The original files are not removed.
+
+    Returns:
+        (bundles, others) - a list of (bundle_path, member_paths) and the paths that weren't bundled
+    """
+    groups, others = plan_bundles(paths, threshold, target_size)
+    if not groups:
+        return [], others
+
+    os.makedirs(dest_dir, exist_ok=True)
+    start_time = time.strftime('%Y%m%d_%H%M%S')
+
+    bundles = []
+    for n, group in enumerate(groups):
+        bundle_path = os.path.join(dest_dir, f'{prefix}_{start_time}_{n}.tar')
+        write_bundle(group, root, bundle_path)
+        bundles.append((bundle_path, group))
+        logger.info('Bundled %s files into %s', len(group), bundle_path)
+
+    return bundles, others
+
+def unbundle(bundle_path, dest_dir):
+    """
+    Server side: extract a bundle into dest_dir, checking every file against the manifest.
+
+    Returns:
+        The paths of the extracted files
+    """
+    dest_dir = os.path.abspath(dest_dir)
+    extracted = []
+
+    with tarfile.open(bundle_path) as tar:
+        manifest = json.load(tar.extractfile(MANIFEST_NAME))
+
+        for entry in manifest:
+            # Never write outside dest_dir, whatever the manifest says
+            target = os.path.normpath(os.path.join(dest_dir, entry['path']))
+            if not target.startswith(dest_dir + os.sep):
+                raise ValueError(f"{entry['path']} in {bundle_path} points outside {dest_dir}")
+
+            data = tar.extractfile(entry['path']).read()
+            if len(data) != entry['size'] or _md5(data) != entry['md5']:
+                raise ValueError(f"{entry['path']} in {bundle_path} doesn't match the manifest")
+
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            with open(target, 'wb') as f:
+                f.write(data)
+            os.utime(target, (entry['mtime'], entry['mtime']))
+            extracted.append(target)
+
+    return extracted
+
+def main():
+    parser = argparse.ArgumentParser(description='Unpack upload bundles created on the RPi')
+    parser.add_argument('bundles', nargs='+', help='bundle .tar files')
+    parser.add_argument('-o', '--output', default='.', help='directory to extract into, usually the cloud_dir')
+    args = parser.parse_args()
+
+    for bundle_path in args.bundles:
+        extracted = unbundle(bundle_path, args.output)
+        print(f"Extracted {len(extracted)} files from {bundle_path}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,154 @@
+"""
+Running system commands (nmcli, hwclock, date...) with a timeout, so a hung one can't hold up the wake cycle.
+
+    from .commands import run, start
+
+    result = run(['sudo', 'hwclock', '-w'], timeout=10)
+    if not result.ok:
+        logger.error('hwclock failed: %s', result)
+
+    task = start(['nmcli', 'connection', 'up', 'uuid', uuid], timeout=90) # carries on in the background
+    ...
+    result = task.result()
+
+Output is read on a separate thread into a bounded buffer, only the last max_output bytes are kept.
+A command that runs past its timeout is sent SIGTERM, then SIGKILL if it still hasn't gone, along with
+everything it started (the shell, sudo and its child). The result has the return code and elapsed time.
+"""
+
+import logging
+import os
+import signal
+import subprocess
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+DEFAULT_TIMEOUT = 60 # seconds
+
+# Output kept per command, the end of the output is kept as that's where the errors are
+MAX_OUTPUT = 64 * 1024 # bytes
+
+# Time a command gets to exit after SIGTERM before it's killed
+KILL_GRACE = 2 # seconds
+
+READ_SIZE = 4096
+
+# Shared by every background command, and other short background jobs like the time sync
+BACKGROUND_WORKERS = 4
+_executor = None
+_executor_lock = threading.Lock()
+
+class CommandResult:
+    """ What happened when a command ran """
+    def __init__(self, args, returncode, output, elapsed, timed_out=False, truncated=False):
+        self.args = args
+        self.returncode = returncode
+        self.output = output
+        self.elapsed = elapsed
+        self.timed_out = timed_out
+        self.truncated = truncated
+
+    @property
+    def ok(self):
+        return self.returncode == 0 and not self.timed_out
+
+    def __repr__(self):
+        state = 'timed out' if self.timed_out else f'exit {self.returncode}'
+        return f'<CommandResult {self.args!r} {state} after {self.elapsed:.2f}s>'
+
+def _read_output(stream, chunks, max_output, state):
+    """ Read stream to the end, keeping only the last max_output bytes in chunks """
+    size = 0
+    for data in iter(lambda: os.read(stream.fileno(), READ_SIZE), b''):
+        chunks.append(data)
+        size += len(data)
+        while size - len(chunks[0]) >= max_output:
+            size -= len(chunks.popleft())
+            state['truncated'] = True
+    stream.close()
+
+def _stop(process):
+    """ SIGTERM the command's process group, then SIGKILL it if it doesn't exit in time """
+    for sig in (signal.SIGTERM, signal.SIGKILL):
+        try:
+            os.killpg(process.pid, sig)
+        except (ProcessLookupError, PermissionError):
+            process.send_signal(sig)
+        try:
+            process.wait(KILL_GRACE)
+            return
+        except subprocess.TimeoutExpired:
+            continue
+
+def run(args, timeout=DEFAULT_TIMEOUT, shell=None, max_output=MAX_OUTPUT, log_output=False):
+    """
+    Run a command and wait for it to finish, or for timeout seconds at most (None waits forever).
+    args is a list, or a string which is run through the shell unless shell=False. stderr is merged into the output.
+
+    Returns:
+        A CommandResult. It never raises for a failing or hung command, only if it can't be started at all
+    """
+    if shell is None:
+        shell = isinstance(args, str)
+
+    start_time = time.monotonic()
+    # In its own session, so on a timeout the whole group can be stopped and not just the shell
+    process = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, stdin=subprocess.DEVNULL,
+                               shell=shell, start_new_session=True)
+
+    chunks = deque()
+    state = {'truncated': False}
+    reader = threading.Thread(target=_read_output, args=(process.stdout, chunks, max_output, state), daemon=True)
+    reader.start()
+
+    timed_out = False
+    try:
+        process.wait(timeout)
+    except subprocess.TimeoutExpired:
+        timed_out = True
+        _stop(process)
+    reader.join(KILL_GRACE)
+
+    output = b''.join(chunks)
+    truncated = state['truncated'] or len(output) > max_output
+    output = output[-max_output:].decode('utf8', errors='replace')
+    result = CommandResult(args, process.returncode, output, time.monotonic() - start_time, timed_out, truncated)
+
+    if timed_out:
+        logger.error('%s timed out after %.1fs', args, result.elapsed)
+    else:
+        logger.debug('%s exited %s after %.2fs', args, result.returncode, result.elapsed)
+    if log_output:
+        for line in output.splitlines():
+            logger.info(line.strip())
+
+    return result
+
+def _get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=BACKGROUND_WORKERS, thread_name_prefix='command')
+        return _executor
+
+def submit(fn, *args, **kwargs):
+    """ Call fn(*args, **kwargs) on the shared background threads. Returns a Future of its result """
+    return _get_executor().submit(fn, *args, **kwargs)
+
+def start(args, timeout=DEFAULT_TIMEOUT, **kwargs):
+    """
+    Run a command in the background, with the same arguments as run().
+
+    Returns:
+        A Future, its result() is the CommandResult once the command has finished
+    """
+    return submit(run, args, timeout, **kwargs)
+
+def run_many(commands, timeout=DEFAULT_TIMEOUT, **kwargs):
+    """ Run independent commands at the same time and return their CommandResults in the same order """
+    return [task.result() for task in [start(args, timeout, **kwargs) for args in commands]]
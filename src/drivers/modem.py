@@ -5,6 +5,13 @@ import usb.core
 import os
 import serial
 import RPi.GPIO as GPIO
+from contextlib import contextmanager
+
+try:
+    # Optional, used to wait for the modem to (dis)appear on the USB bus without polling
+    import pyudev
+except ImportError:
+    pyudev = None
 
 from .lock import Lock
 
@@ -22,13 +29,82 @@ CONTROL_INTERFACE_BAUD = 115200
 CONTROL_INTERFACE_TIMEOUT = 1
 CONTROL_INTERFACE_READ_SIZE = 100
 TIME_WAIT_RESPONSE = 0.5
+AT_COMMAND_TIMEOUT = 5 # Longest time to wait for a final result code
+
+# Lines that end the response to an AT command
+FINAL_RESULT_CODES = ("OK", "ERROR", "NO CARRIER")
+FINAL_RESULT_PREFIXES = ("+CME ERROR", "+CMS ERROR")
 
 VENDOR_ID = 0x1199
 PRODUCT_ID = 0x68c0
 
+POWER_ON_TIMEOUT = 22 # Longest time to wait for the modem to enumerate after POWER_ON_N
+POWER_OFF_TIMEOUT = 30 # Longest time to wait for the modem to leave the bus after powering down
+
+# Polling intervals used when udev isn't available, doubling from the first to the last
+POLL_INTERVAL_MIN = 0.05
+POLL_INTERVAL_MAX = 2
+
 class ModemInUseException(Exception):
     """Exception raised when the modem is already in use by another process."""
 
+class ATSession:
+    """
+    Keeps the control interface open for a series of AT commands.
+    Echo is turned off once when the session opens, and each command returns as soon as the
+    modem sends a final result code instead of waiting a fixed time.
+    """
+
+    def __init__(self, port=CONTROL_INTERFACE, baud=CONTROL_INTERFACE_BAUD, timeout=AT_COMMAND_TIMEOUT):
+        self.timeout = timeout
+        self.ser = serial.Serial(port, baud, timeout=CONTROL_INTERFACE_TIMEOUT)
+        try:
+            self.ser.reset_input_buffer()
+            self.command("ATE0")
+        except BaseException:
+            # __exit__ never runs if __init__ fails, so the port has to be closed here
+            self.ser.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """ Close the serial port """
+        self.ser.close()
+
+    def command(self, command, timeout=None):
+        """
+        Send an AT command and read lines until the final result code.
+
+        Returns:
+            list: The non-empty lines of the response, including the result code.
+        """
+        if timeout is None:
+            timeout = self.timeout
+
+        # Drop anything left over, like unsolicited result codes
+        self.ser.reset_input_buffer()
+        self.ser.write((command + "\r\n").encode())
+
+        lines = []
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            line = self.ser.readline().decode('utf-8', errors='replace').strip()
+            if not line:
+                continue
+            lines.append(line)
+            if line in FINAL_RESULT_CODES or line.startswith(FINAL_RESULT_PREFIXES):
+                break
+        else:
+            logger.warning("Timed out waiting for response to AT command %s", command)
+
+        logger.debug("AT command: %s, response: %s", command, lines)
+        return lines
+
 class Modem:
     """
     Provides power control and status information for the RC7620 GSM modem
@@ -45,6 +121,7 @@ class Modem:
             self.result = False
             raise
         self.port = None
+        self.session = None
 
         GPIO.setmode(GPIO.BCM)
         GPIO.setwarnings(False) # Squash warning if the pin is already in use
@@ -109,16 +186,9 @@ class Modem:
         GPIO.output(POWER_ON_N, GPIO.LOW)
 
         logger.info("POWER_ON_N asserted, waiting for modem to boot up...")
-        # Wait for the modem to boot up
-        time.sleep(2)
-        max_tries = 10
-        while(max_tries > 0):
-            logger.info("Checking if modem is enumerated...")
-            if self.is_enumerated():
-                logger.info("Modem is enumerated.")
-                return True
-            time.sleep(2)
-            max_tries -= 1
+        if self.wait_enumerated(True, POWER_ON_TIMEOUT):
+            logger.info("Modem is enumerated.")
+            return True
         
         logger.error("Timed out waiting for modem to boot up.")
         return False
@@ -128,18 +198,67 @@ class Modem:
         Wait for the modem to power down.
         Returns True if the modem has powered down, False otherwise.
         """
-        # Wait for the modem to power down 
-        max_tries = 10
-        while(max_tries > 0):
-            if self.is_enumerated():
-                logger.info("Modem is still powered on. Waiting for it to power down...")
-            else:
-                logger.info("Modem has powered down.")
-                return True
-            time.sleep(3)
-            max_tries -= 1
+        logger.info("Waiting for modem to power down...")
+        if self.wait_enumerated(False, POWER_OFF_TIMEOUT):
+            logger.info("Modem has powered down.")
+            return True
         return False
 
+    def wait_enumerated(self, present, timeout):
+        """
+        Wait for the modem to appear on (present=True) or disappear from (present=False) the USB bus.
+        Uses udev hotplug events if pyudev is installed, otherwise polls with an exponential backoff.
+        Returns True as soon as the modem is in the wanted state, False if the timeout runs out first.
+        """
+        if pyudev is not None:
+            try:
+                return self._wait_udev(present, timeout)
+            except Exception as e:
+                logger.warning("Could not wait for udev events, polling instead: %s", e)
+        return self._wait_polling(present, timeout)
+
+    def _wait_udev(self, present, timeout):
+        """ Wait for the modem's add or remove event from udev """
+        monitor = pyudev.Monitor.from_netlink(pyudev.Context())
+        try:
+            monitor.filter_by(subsystem='usb', device_type='usb_device')
+            monitor.start()
+
+            # Check after the monitor has started so an event just before it can't be missed
+            if self.is_enumerated() == present:
+                return True
+
+            action = 'add' if present else 'remove'
+            product = [f"{VENDOR_ID:x}", f"{PRODUCT_ID:x}"]
+            deadline = time.monotonic() + timeout
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return self.is_enumerated() == present
+                device = monitor.poll(timeout=remaining)
+                if device is None:
+                    return self.is_enumerated() == present
+                # PRODUCT is "vendor/product/bcdDevice" in hex, and is also set on remove events
+                if device.action == action and device.get('PRODUCT', '').split('/')[:2] == product:
+                    return True
+        finally:
+            # pyudev has no close(), libudev closes the netlink socket when the monitor is freed.
+            # Drop the only reference here so that happens now, even if a traceback keeps this frame alive
+            del monitor
+
+    def _wait_polling(self, present, timeout):
+        """ Poll the USB bus, starting fast and backing off """
+        interval = POLL_INTERVAL_MIN
+        deadline = time.monotonic() + timeout
+        while True:
+            if self.is_enumerated() == present:
+                return True
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            time.sleep(min(interval, remaining))
+            interval = min(interval * 2, POLL_INTERVAL_MAX)
+
     def power_off(self):
         """ Command modem to power down safely from software then remove power """
         if not self.is_enumerated():
@@ -175,33 +294,42 @@ class Modem:
 
 
     def is_serial_port_in_use(self, port):
+        """
+        Check if any process has the serial port open, including non-exclusive opens like ModemManager's.
+
+        The device path is resolved once and compared against the target of every fd link in /proc,
+        which is a single readlink per fd. Nothing is cached, another process can open the port at any time.
+        A burst of AT commands should go through at_session(), which only checks when the port is opened.
+        """
         # Normalize the target device path (resolve any symlinks)
         target_device = os.path.realpath(port)
-        
+        own_pid = str(os.getpid())
+
         # Iterate over all processes in /proc
-        for pid in os.listdir('/proc'):
-            if pid.isdigit():
+        with os.scandir('/proc') as procs:
+            for proc in procs:
+                pid = proc.name
+                if not pid.isdigit() or pid == own_pid:
+                    continue
+
                 fds_path = f'/proc/{pid}/fd'
                 try:
                     # List all file descriptors for the current process
                     fds = os.listdir(fds_path)
-                except PermissionError:
-                    # Skip this process if we don't have permission to view its fds
-                    continue
-                except FileNotFoundError:
-                    # Process might have ended; move on to the next
+                except (PermissionError, FileNotFoundError):
+                    # Skip processes we can't see or that have ended
                     continue
                 
                 for fd in fds:
-                    fd_path = os.path.join(fds_path, fd)
                     try:
-                        # Check if this fd is a symlink to our target device
-                        if os.path.realpath(fd_path) == target_device:
+                        # fd links point straight at the resolved device path
+                        if os.readlink(f'{fds_path}/{fd}') == target_device:
                             logger.info(f"Device {port} is in use by process {pid}")
                             return True
-                    except FileNotFoundError:
+                    except OSError:
                         # The fd was closed; move on to the next
                         continue
+
         return False
 
     def send_at_command_no_response(self, command):
@@ -221,42 +349,51 @@ class Modem:
             return None 
 
     
+    @contextmanager
+    def at_session(self):
+        """
+        Open the control interface once for several AT commands.
+        While the session is open, send_at_command and the methods built on it (get_rssi, get_sim_ccid...)
+        all use it instead of opening the port for every command.
+
+            with modem.at_session():
+                rssi = modem.get_rssi()
+                ccid = modem.get_sim_ccid()
+        """
+        if self.session is not None:
+            # Already inside a session, just share it
+            yield self.session
+            return
+
+        # Check port isn't already open. Some processes, like ModemManager, open in non-exclusive mode that pyserial can't detect
+        if self.is_serial_port_in_use(CONTROL_INTERFACE):
+            raise ModemInUseException("Serial port already open")
+
+        with ATSession(CONTROL_INTERFACE) as session:
+            self.session = session
+            try:
+                yield session
+            finally:
+                self.session = None
+
     def send_at_command(self, command):
         """
         Sends an AT command to a modem and returns the response.
+        Uses the open AT session if there is one, otherwise opens the port just for this command.
 
         Returns:
             list: The response from the modem.
         """
-        response = bytes()
-
-
         try:
-            # Check port isn't already open. Some processes, like ModemManager, open in non-exclusive mode that pyserial can't detect
-            if self.is_serial_port_in_use(CONTROL_INTERFACE):
-                raise ModemInUseException("Serial port already open")
+            if self.session is not None:
+                return self.session.command(command)
 
-            # Open the serial port
-            with serial.Serial(CONTROL_INTERFACE, CONTROL_INTERFACE_BAUD, timeout=CONTROL_INTERFACE_TIMEOUT) as ser:
-                ser.write(("ATE0\r\n").encode())
-                time.sleep(0.1)
-                ser.read_all()
-                time.sleep(0.5)
-                ser.write((command + "\r\n").encode())
-                time.sleep(0.5)
-                response = ser.read_all()
+            with self.at_session() as session:
+                return session.command(command)
 
         except serial.SerialException as e:
             logger.error("Failed to send AT command: %s", e)
             return None 
-
-        logger.debug("AT command: %s, response: %s", command, response)
-        s = response.decode('utf-8')
-        lines = s.splitlines()
-        filtered_lines = [line for line in lines if line.strip()] 
-
-        logger.debug(filtered_lines)
-        return filtered_lines
    
     def is_responding(self):
         """
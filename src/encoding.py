@@ -0,0 +1,154 @@
+"""
+FLAC encoding profiles, and picking one automatically for each wake.
+
+A profile sets the FLAC compression level, the number of frames read and handed to libsndfile at a
+time and optionally a lossy reduction before encoding: keeping only the top bit_depth bits of each
+sample (FLAC stores the zeroed low bits for free) or decimating the sample rate by an integer factor.
+
+In 'auto' mode the profile expected to get the backlog converted and uploaded soonest is chosen from
+the lossless ones (or all of them with allow_lossy). The encoder speed and compression ratio of each
+profile are measured on every conversion and kept in a small stats file between boots, the uplink
+rate is estimated from the signal strength. The encoder speed is the CPU time of the encoding alone,
+so it doesn't change with verify_flac, acoustic_summaries or activity_detection.
+"""
+
+import json
+import logging
+
+from .atomic import atomic_write
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# compression_level is 0 (fastest) to 1 (smallest), None is the libsndfile default
+# blocksize is the frames read from the WAV and passed to libsndfile per write, None uses flac_blocksize from utils.
+# It only trades memory for fewer Python round trips, the output is the same: libsndfile doesn't expose the
+# FLAC encoder's own block size, which the compression level picks
+PROFILES = {
+    'fast': {'compression_level': 0.0, 'blocksize': 4 * 65536},
+    'default': {'compression_level': None},
+    'best': {'compression_level': 1.0},
+    'best_12bit': {'compression_level': 1.0, 'bit_depth': 12},
+    'best_half_rate': {'compression_level': 1.0, 'decimate': 2},
+}
+
+# Input bytes encoded per CPU second and output/input size, assumed until a profile has been measured.
+# Rough starting figures for 16 bit AudioMoth recordings on the CM4, benchmarks/flac_profiles.py measures them properly
+DEFAULT_STATS = {
+    'fast': {'speed': 12e6, 'ratio': 0.62},
+    'default': {'speed': 8e6, 'ratio': 0.58},
+    'best': {'speed': 3e6, 'ratio': 0.56},
+    'best_12bit': {'speed': 3e6, 'ratio': 0.35},
+    'best_half_rate': {'speed': 2e6, 'ratio': 0.29},
+}
+
+# Weight of the newest measurement in the running averages
+STATS_SMOOTHING = 0.3
+
+# Uplink bytes/s expected at or above each RSSI in dBm, best first. Below the last one UPLINK_FLOOR is assumed
+UPLINK_BY_RSSI = [(-70, 256 * 1024), (-85, 96 * 1024), (-100, 24 * 1024)]
+UPLINK_FLOOR = 8 * 1024 # bytes/s
+
+# Used when there's no signal strength to go on, same as the scheduler's starting estimate
+UPLINK_UNKNOWN = 32 * 1024 # bytes/s
+
+def get_profile(name):
+    """ The settings of profile name as a dict """
+    if name not in PROFILES:
+        raise ValueError(f"Unknown FLAC profile {name}, must be 'auto' or one of {', '.join(PROFILES)}")
+    return PROFILES[name]
+
+def is_lossless(name):
+    """ False if profile name reduces the bit depth or sample rate """
+    profile = get_profile(name)
+    return not profile.get('bit_depth') and not profile.get('decimate')
+
+def estimate_uplink(rssi_dbm):
+    """ Expected upload rate in bytes/s for a signal strength in dBm, which can be None """
+    if rssi_dbm is None:
+        return UPLINK_UNKNOWN
+    for threshold, rate in UPLINK_BY_RSSI:
+        if rssi_dbm >= threshold:
+            return rate
+    return UPLINK_FLOOR
+
+def load_stats(path):
+    """ Measured speed and ratio of each profile, falling back to DEFAULT_STATS for any not measured yet """
+    stats = {name: dict(values) for name, values in DEFAULT_STATS.items()}
+    try:
+        with open(path) as f:
+            for name, values in json.load(f).items():
+                stats.setdefault(name, {}).update(values)
+    except FileNotFoundError:
+        pass
+    except (OSError, ValueError) as e:
+        logger.error('Could not read FLAC profile stats %s, using the defaults. %s', path, e)
+    return stats
+
+def save_stats(path, stats):
+    """ Write the stats through a temporary file, a power cut only loses the latest measurements """
+    try:
+        with atomic_write(path) as f:
+            json.dump(stats, f, indent=1)
+    except OSError as e:
+        logger.error('Could not save FLAC profile stats %s. %s', path, e)
+
+def update_stats(stats, name, input_bytes, output_bytes, cpu_s):
+    """ Fold one conversion into the running averages of profile name """
+    if not input_bytes or not cpu_s:
+        return
+    entry = stats.setdefault(name, dict(DEFAULT_STATS.get(name, {'speed': input_bytes / cpu_s, 'ratio': output_bytes / input_bytes})))
+    entry['speed'] += STATS_SMOOTHING * (input_bytes / cpu_s - entry['speed'])
+    entry['ratio'] += STATS_SMOOTHING * (output_bytes / input_bytes - entry['ratio'])
+
+def select_profile(stats, backlog_bytes, rssi_dbm=None, workers=1, allow_lossy=False):
+    """
+    Pick the profile that should get backlog_bytes of WAV converted and uploaded in the least time,
+    counting encoding spread over workers CPUs plus uploading the result at the rate expected for rssi_dbm.
+    A weak signal favours the smaller output of the slower profiles, a strong one the faster encoders.
+    """
+    uplink = estimate_uplink(rssi_dbm)
+    candidates = [name for name in PROFILES if allow_lossy or is_lossless(name)]
+
+    def expected_time(name):
+        entry = stats.get(name) or DEFAULT_STATS[name]
+        return backlog_bytes / (entry['speed'] * workers) + backlog_bytes * entry['ratio'] / uplink
+
+    best = min(candidates, key=expected_time)
+    logger.info('Chose FLAC profile %s for %.1f MB at %s dBm (about %.0f s to convert and upload)',
+                best, backlog_bytes / 1024 / 1024, rssi_dbm, expected_time(best))
+    return best
+
+def reduce_bit_depth(block, bits):
+    """ Zero all but the top bits of each 16 bit sample in place """
+    mask = ~((1 << (16 - bits)) - 1)
+    block &= mask
+    return block
+
+class Decimator:
+    """
+    Streaming integer factor downsampling of int16 blocks, low pass filtered with a windowed sinc first
+    so nothing above the new Nyquist frequency aliases in. The filter delays the output by about taps / 2 samples.
+    """
+    def __init__(self, factor, channels, taps=63):
+        import numpy as np
+
+        self.factor = factor
+        n = np.arange(taps) - (taps - 1) / 2
+        self.kernel = (np.sinc(n / factor) / factor * np.hamming(taps)).astype('float32')
+        self.history = np.zeros((taps - 1, channels), dtype='float32')
+        self.phase = 0
+
+    def process(self, block):
+        """ Filter and decimate one block, returns a new int16 array with about len(block) / factor frames """
+        import numpy as np
+
+        x = np.concatenate([self.history, block.astype('float32')])
+        self.history = x[len(x) - len(self.history):]
+
+        filtered = np.stack([np.convolve(x[:, c], self.kernel, 'valid') for c in range(x.shape[1])], axis=1)
+        out = filtered[self.phase::self.factor]
+        # Carry the position of the next kept sample over to the next block
+        self.phase = (self.phase - len(block)) % self.factor
+
+        return np.clip(np.rint(out), -32768, 32767).astype('int16')
@@ -6,14 +6,22 @@ On startup, setup_logging() is called to configure the logging to both stdout an
 The current time and CPU serial number are used to create a unique log file name.
 
 This means that each boot of the device will create a new log file.
+
+By default records are passed through a queue to a background thread which does the formatting and writing,
+so logging doesn't block on the SD card. close() must be called before power off to make sure the queue is written out.
 """
 
+import atexit
+import copy
 import logging
-from logging.handlers import WatchedFileHandler
+from logging.handlers import WatchedFileHandler, QueueHandler, QueueListener
 import os
+import queue
 import time
 import sys
 import shutil
+import tarfile
+from .atomic import atomic_write
 from .utils import discover_serial
 
 # The log_dir can't be included in config because we're
@@ -25,16 +33,70 @@ LOG_DIR = '/home/src/logs/'
 STDOUT_DEFAULT_LOG_LEVEL = logging.DEBUG
 FILE_DEFAULT_LOG_LEVEL = logging.DEBUG
 
+# Write log records from a background thread instead of the thread that logged them
+QUEUED_LOGGING = True
+# Pack finished logs into one compressed archive per boot instead of uploading each one separately
+BUNDLE_LOGS = True
+BUNDLE_COMPRESS_LEVEL = 6
+
+# Most records waiting to be written, logging blocks when it's full rather than dropping records
+LOG_QUEUE_SIZE = 10000
+
+class BatchedFlushMixin:
+    """
+    Skips the flush after every record, the queue listener calls flush_batch() once the queue runs empty instead.
+    Set batching to False to go back to flushing every record.
+    """
+    batching = True
+
+    def flush(self):
+        if not self.batching:
+            super().flush()
+
+    def flush_batch(self):
+        super().flush()
+
+class BatchedStreamHandler(BatchedFlushMixin, logging.StreamHandler):
+    pass
+
+class BatchedFileHandler(BatchedFlushMixin, logging.FileHandler):
+    pass
+
+class BlockingQueueHandler(QueueHandler):
+    """ QueueHandler that waits for space in a full queue and leaves the formatting to the listener thread """
+    def enqueue(self, record):
+        self.queue.put(record)
+
+    def prepare(self, record):
+        # Only merge the message arguments here, the formatter runs on the listener thread
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+class BatchingQueueListener(QueueListener):
+    """ QueueListener that flushes its handlers only when the queue is empty, so bursts are written together """
+    def handle(self, record):
+        super().handle(record)
+        if self.queue.empty():
+            self.flush()
+
+    def flush(self):
+        for handler in self.handlers:
+            handler.flush_batch()
+
 class Log:
     """
     Setup logging for the application
 
     Called once at the start of the application to setup logging to both stdout and a file
     """
-    def __init__(self):
+    def __init__(self, queued=QUEUED_LOGGING):
         """ Setup the logger to log to both stdout and a file"""
         self.log_dir = LOG_DIR
         self.cpu_serial = discover_serial()
+        self.queued = queued
+        self.listener = None
 
         # Create log directory if it doesn't exist
         os.makedirs(self.log_dir, exist_ok=True)
@@ -50,10 +112,21 @@ class Log:
         self.formatter = logging.Formatter(f'{self.cpu_serial} - %(asctime)s - %(name)s - %(levelname)s - %(message)s')
         
         # Handler for stdout
-        self.stdout_handler = logging.StreamHandler(sys.stdout)
+        if self.queued:
+            self.stdout_handler = BatchedStreamHandler(sys.stdout)
+        else:
+            self.stdout_handler = logging.StreamHandler(sys.stdout)
         self.stdout_handler.setLevel(STDOUT_DEFAULT_LOG_LEVEL)
         self.stdout_handler.setFormatter(self.formatter)
-        self.logger.addHandler(self.stdout_handler)
+
+        # With queued logging the only handler on the logger is the queue, the listener thread owns the real handlers
+        if self.queued:
+            self.queue = queue.Queue(LOG_QUEUE_SIZE)
+            self.queue_handler = BlockingQueueHandler(self.queue)
+            self.logger.addHandler(self.queue_handler)
+            atexit.register(self.close)
+        else:
+            self.logger.addHandler(self.stdout_handler)
 
         # Handler for file is created in rotate_log()
         self.file_handler = None
@@ -82,35 +155,107 @@ class Log:
         """
         Rotate the log file by closing the current one and creating a new one.
         """
+        # Write out everything queued for the old file before swapping it
+        self.stop_listener()
+
         if self.file_handler:
-            self.logger.removeHandler(self.file_handler)
+            if not self.queued:
+                self.logger.removeHandler(self.file_handler)
             self.file_handler.close()
 
         fn = self.generate_new_logfile_name()
-        self.file_handler = WatchedFileHandler(filename=fn)
+        if self.queued:
+            self.file_handler = BatchedFileHandler(filename=fn)
+        else:
+            self.file_handler = WatchedFileHandler(filename=fn)
         self.file_handler.setLevel(FILE_DEFAULT_LOG_LEVEL)
         self.file_handler.setFormatter(self.formatter)
-        self.logger.addHandler(self.file_handler)
+
+        if self.queued:
+            self.listener = BatchingQueueListener(self.queue, self.stdout_handler, self.file_handler,
+                                                  respect_handler_level=True)
+            self.listener.start()
+        else:
+            self.logger.addHandler(self.file_handler)
 
         self.logger.info('Logging to file %s', fn)
 
+    def stop_listener(self):
+        """ Stop the queue listener, once every record already queued has been written """
+        if self.listener:
+            self.listener.stop()
+            self.listener.flush()
+            self.listener = None
+
+    def close(self):
+        """
+        Write out any queued records and close the log file.
+        Must be called before the RPi powers off, or the last records can be lost.
+        """
+        self.stop_listener()
+        if self.queued and self.queue_handler in self.logger.handlers:
+            # Anything logged from here on is written straight away by the handlers themselves
+            self.logger.removeHandler(self.queue_handler)
+            for handler in (self.stdout_handler, self.file_handler):
+                handler.batching = False
+                self.logger.addHandler(handler)
+
+    def move_archived_to_dir(self, upload_dir, bundle=BUNDLE_LOGS, extra_files=()):
+        """
+        Move the archived log files to the upload directory.
+
+        With bundle=True all finished logs, and any extra_files (e.g. telemetry), are packed into a single
+        gzipped tar instead, so they go up as one object. The originals are removed once the archive is written.
 
-    def move_archived_to_dir(self, upload_dir):
-        """ Move the archived log files to the upload directory """
+        Returns:
+            A list of the files placed in the upload directory
+        """
+        moved = []
         try:
             upload_dir_logs = os.path.join(upload_dir, 'logs')
             os.makedirs(upload_dir_logs, exist_ok=True)
 
             log_dir = self.log_dir
 
+            # Timing records (.jsonl) from earlier boots go up with the logs
             existing_logs = [f for f in os.listdir(log_dir)
-                             if f.endswith('.log')
+                             if f.endswith(('.log', '.jsonl'))
                                 and f != os.path.basename(self.get_current_log_filename())]
 
+            if bundle:
+                files = [os.path.join(log_dir, log) for log in existing_logs] + list(extra_files)
+                if files:
+                    moved.append(self.bundle_files(files, upload_dir_logs))
+                return moved
+
             for log in existing_logs:
                 shutil.move(os.path.join(log_dir, log),
                         os.path.join(upload_dir_logs, log))
+                moved.append(os.path.join(upload_dir_logs, log))
                 self.logger.info('Moved %s to upload', log)
+
+            for path in extra_files:
+                dest = os.path.join(upload_dir_logs, os.path.basename(path))
+                shutil.move(path, dest)
+                moved.append(dest)
+                self.logger.info('Moved %s to upload', path)
         except OSError as e:
             # not critical - can leave logs in the log_dir
-            self.logger.error('Could not move existing logs to upload. %s', e)
\ No newline at end of file
+            self.logger.error('Could not move existing logs to upload. %s', e)
+        return moved
+
+    def bundle_files(self, files, dest_dir):
+        """ Pack files into one .tar.gz in dest_dir, then delete them. Returns the path of the archive """
+        start_time = time.strftime('%Y%m%d_%H%M%S')
+        fn = os.path.join(dest_dir, f'rpi_eco_{self.cpu_serial}_{start_time}.tar.gz')
+
+        # Written under a hidden temporary name so a half written archive is never uploaded
+        with atomic_write(fn, 'wb', hidden=True) as out, tarfile.open(fileobj=out, mode='w:gz', compresslevel=BUNDLE_COMPRESS_LEVEL) as tar:
+            for f in files:
+                tar.add(f, arcname=os.path.basename(f))
+
+        for f in files:
+            os.remove(f)
+
+        self.logger.info('Bundled %s files into %s', len(files), fn)
+        return fn
@@ -1,8 +1,10 @@
+import os
 import time
 import logging
 
 from .logs import Log
-from .utils import convert_directory, server_sync, shut_down
+from .utils import convert_directory, server_sync, pipeline_sync, shut_down
+from .timing import timings, span
 from drivers.modem import Modem
 
 #config file
@@ -13,6 +15,9 @@ sd_mount_loc = 'mnt/x/' #x needs filled in with actual USB location (can be foun
 
 GLOBAL_is_connected = False
 
+#Convert and upload at the same time, with the modem booting in the background while files convert
+pipeline_mode = True #Set to False to convert everything first and then upload
+
 #Logging
 log = Log() #Make log object global
 logger = log.logger
@@ -20,7 +25,7 @@ logger.setLevel(logging.INFO)
 
 def main():
     modem = Modem()
-    start_time = time.strf('%Y%m%d_%H%M')
+    start_time = time.strftime('%Y%m%d_%H%M')
     
     logging.getLogger().setLevel(logging.INFO)
     logger.info('RPi starting at %s' % start_time)
@@ -28,10 +33,18 @@ def main():
     wav_directory = "pathtowavfiles" #Needs changed to actual file path
 
     try:
-       convert_directory(wav_directory) 
-       server_sync(cloud_dir="project-name", credentials_path=credentials_name, modem=modem)
+       with span('wake_cycle', pipeline=pipeline_mode):
+           if pipeline_mode:
+               pipeline_sync(wav_directory, cloud_dir="project-name", credentials_path=credentials_name, modem=modem, log=log)
+           else:
+               new_files = []
+               convert_directory(wav_directory, on_converted=new_files.append)
+               server_sync(cloud_dir="project-name", credentials_path=credentials_name, modem=modem, log=log, new_files=new_files)
+
+       #Timings of this boot are uploaded with the logs on the next one
+       timings.write(os.path.join(log.log_dir, f'rpi_eco_{log.cpu_serial}_{start_time}.timing.jsonl'))
        time.sleep(1) #Small delay to make sure its ready to power down
-       shut_down()
+       shut_down(log=log, modem=modem)
     
     except Exception as e:
         logging.error('Caught exception on main record() function: %s', e)
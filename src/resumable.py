@@ -0,0 +1,162 @@
+"""
+Resumable, chunked uploads to GCS that can carry on after the link drops or the RPi powers off.
+
+The upload session URI and the number of bytes GCS has committed are kept in a small journal on disk.
+On the next boot the upload continues from the last committed chunk instead of from byte 0.
+This follows the GCS JSON API resumable upload protocol https://cloud.google.com/storage/docs/performing-resumable-uploads
+"""
+
+import json
+import logging
+import os
+import threading
+
+from .atomic import atomic_write
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+UPLOAD_URL = 'https://storage.googleapis.com/upload/storage/v1/b/{bucket}/o'
+
+# GCS requires every chunk except the last to be a multiple of 256 KiB
+CHUNK_ALIGNMENT = 256 * 1024
+
+# Status code GCS uses for "upload incomplete, send the rest"
+RESUME_INCOMPLETE = 308
+
+class UploadJournal:
+    """
+    Keeps track of unfinished resumable uploads, keyed on local path.
+    Every change is written straight to disk so it survives a power off.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.entries = {}
+
+        try:
+            with open(self.path) as f:
+                self.entries = json.load(f)
+        except FileNotFoundError:
+            pass
+        except ValueError as e:
+            # A broken journal only means starting those uploads again
+            logger.error('Could not read upload journal %s, starting a new one. %s', self.path, e)
+
+    def get(self, local_path):
+        """ Return the journal entry for local_path, or None if there isn't one """
+        with self.lock:
+            entry = self.entries.get(local_path)
+            return dict(entry) if entry else None
+
+    def update(self, local_path, **fields):
+        """ Create or update the entry for local_path """
+        with self.lock:
+            self.entries.setdefault(local_path, {}).update(fields)
+            self._save()
+
+    def remove(self, local_path):
+        """ Forget local_path once its upload has finished """
+        with self.lock:
+            if self.entries.pop(local_path, None) is not None:
+                self._save()
+
+    def _save(self):
+        with atomic_write(self.path) as f:
+            json.dump(self.entries, f)
+
+def _committed_bytes(response):
+    """ Number of bytes GCS has stored, from the Range header of a 308 response """
+    range_header = response.headers.get('Range')
+    if not range_header:
+        return 0
+    return int(range_header.split('-')[1]) + 1
+
+def start_session(session, bucket_name, remote_path, size, md5=None):
+    """ Start a resumable upload session and return its URI. If md5 is given GCS rejects the upload unless it matches """
+    metadata = {'name': remote_path}
+    if md5:
+        metadata['md5Hash'] = md5
+
+    response = session.post(UPLOAD_URL.format(bucket=bucket_name),
+                            params={'uploadType': 'resumable'},
+                            json=metadata,
+                            headers={'X-Upload-Content-Length': str(size),
+                                     'X-Upload-Content-Type': 'application/octet-stream'})
+    response.raise_for_status()
+    return response.headers['Location']
+
+def query_offset(session, session_uri, size):
+    """
+    Ask GCS how much of an upload session it already has.
+
+    Returns:
+        The number of committed bytes, size if the upload has already completed,
+        or None if the session has expired and the upload has to start again.
+    """
+    response = session.put(session_uri, headers={'Content-Range': 'bytes */{}'.format(size)})
+
+    if response.status_code in (200, 201):
+        return size
+    if response.status_code == RESUME_INCOMPLETE:
+        return _committed_bytes(response)
+    if response.status_code in (404, 410):
+        return None
+
+    response.raise_for_status()
+    return None
+
+def resumable_upload(session, bucket_name, local_path, remote_path, journal, chunk_size, md5=None, progress=None):
+    """
+    Upload local_path in chunks of chunk_size bytes, picking up any session for it left in the journal.
+    Raises an exception if a chunk fails, the journal then holds the offset to continue from next time.
+    md5 is the base64 MD5 of the file, if known, which GCS checks the finished upload against.
+    progress, if given, is called with the number of bytes GCS has newly committed after each chunk.
+    """
+    # Every chunk except the last must be a multiple of 256 KiB
+    chunk_size = max(CHUNK_ALIGNMENT, chunk_size - chunk_size % CHUNK_ALIGNMENT)
+
+    size = os.path.getsize(local_path)
+    mtime = os.path.getmtime(local_path)
+
+    offset = None
+    entry = journal.get(local_path)
+
+    # Only resume if it's the same file going to the same place
+    if entry and entry.get('remote_path') == remote_path and entry.get('size') == size and entry.get('mtime') == mtime:
+        session_uri = entry['session_uri']
+        offset = query_offset(session, session_uri, size)
+        if offset is not None:
+            logger.info('Resuming upload of %s at byte %s of %s', local_path, offset, size)
+
+    if offset is None:
+        session_uri = start_session(session, bucket_name, remote_path, size, md5)
+        offset = 0
+        journal.update(local_path, session_uri=session_uri, remote_path=remote_path, size=size, mtime=mtime, offset=offset)
+
+    if size == 0:
+        response = session.put(session_uri, headers={'Content-Range': 'bytes */0'})
+        response.raise_for_status()
+
+    with open(local_path, 'rb') as f:
+        while offset < size:
+            f.seek(offset)
+            chunk = f.read(chunk_size)
+            end = offset + len(chunk) - 1
+            response = session.put(session_uri, data=chunk,
+                                   headers={'Content-Range': 'bytes {}-{}/{}'.format(offset, end, size)})
+
+            previous = offset
+            if response.status_code in (200, 201):
+                offset = size
+            elif response.status_code == RESUME_INCOMPLETE:
+                offset = _committed_bytes(response)
+                journal.update(local_path, offset=offset)
+            else:
+                response.raise_for_status()
+                raise RuntimeError('Unexpected response {} uploading {}'.format(response.status_code, local_path))
+
+            if progress is not None and offset > previous:
+                progress(offset - previous)
+
+    journal.remove(local_path)
@@ -0,0 +1,136 @@
+"""
+Decides which files to upload, in what order, within the time the modem is allowed to stay awake.
+
+The scheduler orders the pending files by a policy and keeps an estimate of the upload throughput
+from the bytes actually sent so far, including the chunks of uploads still in progress, over the time
+at least one upload was running. Time spent with nothing to upload (e.g. waiting on the conversion in
+pipeline mode) doesn't count. A file is only started if it's expected to finish before the deadline,
+so the window isn't spent on a large file that can't complete while small ones wait. Until the
+throughput has been measured a file can always start when nothing else is being sent, and the
+uploader waits for the measurement before turning a file down.
+"""
+
+import fnmatch
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# Files matching these patterns go first under the 'priority' policy, in this order
+PRIORITY_PATTERNS = ['*telemetry*', '*.summary.npz', '*/bundles/summaries_*', '*.log', '*/logs/*']
+
+# Throughput assumed while it hasn't been measured yet, deliberately pessimistic for a poor LTE link
+INITIAL_RATE = 32 * 1024 # bytes/s
+
+# Uploads have to have been running this long before the measured throughput is used
+MIN_MEASURE_TIME = 2 # seconds
+
+# Time kept free at the end of the window for closing down the modem
+SAFETY_MARGIN = 30 # seconds
+
+def priority_rank(path):
+    """ Index of the first PRIORITY_PATTERNS entry matching path, or len(PRIORITY_PATTERNS) if none do """
+    for rank, pattern in enumerate(PRIORITY_PATTERNS):
+        if fnmatch.fnmatch(path, pattern):
+            return rank
+    return len(PRIORITY_PATTERNS)
+
+POLICIES = {
+    'newest': lambda path, stat: -stat.st_mtime,
+    'oldest': lambda path, stat: stat.st_mtime,
+    'smallest': lambda path, stat: stat.st_size,
+    'priority': lambda path, stat: (priority_rank(path), stat.st_size),
+}
+
+class UploadScheduler:
+    """
+    Orders uploads by policy and only lets a file start if it is expected to finish before the deadline.
+    The deadline is budget seconds after the scheduler is created, a budget of None means there is no deadline.
+    """
+    def __init__(self, budget, policy='priority', margin=SAFETY_MARGIN, initial_rate=INITIAL_RATE):
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown upload policy {policy}, must be one of {', '.join(POLICIES)}")
+
+        self.deadline = None if budget is None else time.monotonic() + budget
+        self.policy = policy
+        self.margin = margin
+        self.initial_rate = initial_rate
+
+        self.lock = threading.Lock()
+        self.active = 0
+        self.active_since = None
+        self.active_time = 0.0
+        self.bytes_sent = 0
+
+    def order(self, paths):
+        """ Return paths sorted by the scheduler's policy """
+        key = POLICIES[self.policy]
+
+        def sort_key(path):
+            try:
+                return key(path, os.stat(path))
+            except OSError:
+                # Let the upload fail and be recorded rather than dropping it here
+                return key(path, os.stat_result((0,) * 10))
+
+        return sorted(paths, key=sort_key)
+
+    def _active_time(self):
+        if self.active:
+            return self.active_time + time.monotonic() - self.active_since
+        return self.active_time
+
+    def _measured(self):
+        return self.bytes_sent > 0 and self._active_time() >= MIN_MEASURE_TIME
+
+    def measured(self):
+        """ True once enough has been sent for rate() to be the measured throughput """
+        with self.lock:
+            return self._measured()
+
+    def rate(self):
+        """ Combined upload throughput in bytes/s, over the time uploads were running """
+        with self.lock:
+            if not self._measured():
+                return self.initial_rate
+            return self.bytes_sent / self._active_time()
+
+    def remaining(self):
+        """ Seconds left before uploads have to stop """
+        if self.deadline is None:
+            return float('inf')
+        return self.deadline - self.margin - time.monotonic()
+
+    def can_start(self, size, in_flight_bytes=0):
+        """ True if size more bytes, after those already being sent, are expected to finish in time """
+        remaining = self.remaining()
+        if remaining <= 0:
+            return False
+        with self.lock:
+            # Nothing to go on yet, so let one file start and measure the link with it
+            if self.active == 0 and not self._measured():
+                return True
+        expected = (in_flight_bytes + size) / self.rate()
+        return expected <= remaining
+
+    def started(self):
+        """ Called when an upload starts, the throughput is measured over the time at least one is running """
+        with self.lock:
+            if self.active == 0:
+                self.active_since = time.monotonic()
+            self.active += 1
+
+    def progress(self, n):
+        """ Called with the number of bytes sent each time part of an upload has gone through """
+        with self.lock:
+            self.bytes_sent += n
+
+    def finished(self):
+        """ Called when an upload ends, whether or not it succeeded """
+        with self.lock:
+            self.active -= 1
+            if self.active == 0:
+                self.active_time += time.monotonic() - self.active_since
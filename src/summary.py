@@ -0,0 +1,155 @@
+"""
+Compact acoustic summaries of each recording, small enough to go up first even over a poor link.
+
+The summary is worked out on the same streaming read as the FLAC conversion. The audio is cut into
+non-overlapping Hann windowed FFT frames of NFFT samples (at 48 kHz), and the power in each of N_BANDS log spaced
+bands is added up per minute in one matrix multiply per block. For every minute the summary holds:
+
+    band_db        mean level of each band in dBFS, a coarse spectrogram
+    rms_db         overall level in dBFS
+    peak_db        highest sample in dBFS
+    aci            acoustic complexity index, summed over the bands
+    entropy        spectral entropy of the band levels, 0 (one band) to 1 (flat)
+    ndsi           normalised difference soundscape index, biophony (2-8 kHz) against anthrophony (1-2 kHz)
+
+It's saved as a compressed NumPy .npz file, <name>.summary.npz, of a few kilobytes per hour of audio:
+
+    summary = numpy.load('20240101_000000.summary.npz')
+    summary['band_db'][minute, band], summary['band_edges_hz']
+"""
+
+import os
+
+from .atomic import atomic_write
+
+# FFT frame at 48 kHz, scaled with the sample rate so the frequency resolution stays the same
+NFFT = 1024
+N_BANDS = 32
+BAND_MIN_HZ = 100
+
+ANTHROPHONY_HZ = (1000, 2000)
+BIOPHONY_HZ = (2000, 8000)
+
+SUMMARY_SUFFIX = '.summary.npz'
+
+def summary_path(path):
+    """ Path of the summary of a recording, from the path of the recording or its FLAC """
+    return os.path.splitext(path)[0] + SUMMARY_SUFFIX
+
+class SummaryAccumulator:
+    """ Builds the per minute summary from int16 blocks of any size, fed in order with feed() """
+    def __init__(self, samplerate, channels, nfft=None, n_bands=N_BANDS):
+        import numpy as np
+
+        if nfft is None:
+            nfft = NFFT * max(1, samplerate // 48000)
+        self.samplerate = samplerate
+        self.nfft = nfft
+        self.frames_per_minute = max(1, samplerate * 60 // nfft)
+
+        # Band edges from BAND_MIN_HZ to Nyquist, and a (bins, bands) matrix summing the FFT bins of each band.
+        # The lowest edge is raised until the narrowest band is at least one FFT bin wide, so none are empty.
+        # The anthrophony and biophony ranges for the NDSI are two extra columns
+        nyquist = samplerate / 2
+        low = min(BAND_MIN_HZ, nyquist / 2)
+        while low * ((nyquist / low) ** (1 / n_bands) - 1) < samplerate / nfft:
+            low *= 1.25
+        self.band_edges = np.geomspace(low, nyquist, n_bands + 1)
+        freqs = np.fft.rfftfreq(nfft, 1 / samplerate)
+        ranges = list(zip(self.band_edges[:-1], self.band_edges[1:])) + [ANTHROPHONY_HZ, BIOPHONY_HZ]
+        self.band_matrix = np.stack([(freqs >= lo) & (freqs < hi) for lo, hi in ranges], axis=1).astype('float32')
+        self.n_bands = n_bands
+
+        self.window = np.hanning(nfft).astype('float32')
+        # Scales the summed bin powers to the mean square of the band, in full scale units
+        self.scale = 2 / (nfft * np.sum(self.window ** 2) * 32768 ** 2)
+
+        self.remainder = np.empty((0,), dtype='float32')
+        self.frame_count = 0
+        self.previous = None
+        self.minutes = {}
+
+    def _minute(self, index):
+        import numpy as np
+
+        if index not in self.minutes:
+            self.minutes[index] = {
+                'frames': 0,
+                'power': np.zeros(self.band_matrix.shape[1]),
+                'aci_diff': np.zeros(self.n_bands),
+                'square_sum': 0.0,
+                'peak': 0,
+            }
+        return self.minutes[index]
+
+    def feed(self, block):
+        """ Add the next block of the recording """
+        import numpy as np
+
+        mono = block.mean(axis=1, dtype='float32') if block.shape[1] > 1 else block[:, 0].astype('float32')
+        data = np.concatenate([self.remainder, mono])
+        n = len(data) // self.nfft
+        self.remainder = data[n * self.nfft:]
+        if not n:
+            return
+
+        frames = data[:n * self.nfft].reshape(n, self.nfft)
+        power = (np.abs(np.fft.rfft(frames * self.window, axis=1)) ** 2 @ self.band_matrix) * self.scale
+        square_sums = np.einsum('ij,ij->i', frames, frames)
+        peaks = np.abs(frames).max(axis=1)
+
+        # Differences between neighbouring frames, including the last frame of the previous block
+        bands = power[:, :self.n_bands]
+        previous = bands[:1] if self.previous is None else self.previous[np.newaxis]
+        diffs = np.abs(np.diff(np.concatenate([previous, bands]), axis=0))
+        self.previous = bands[-1]
+
+        minute_of_frame = (self.frame_count + np.arange(n)) // self.frames_per_minute
+        first_of_minute = (self.frame_count + np.arange(n)) % self.frames_per_minute == 0
+        # The complexity index is counted within each minute, not across the boundary
+        diffs[first_of_minute] = 0
+        self.frame_count += n
+
+        for minute in np.unique(minute_of_frame):
+            rows = minute_of_frame == minute
+            entry = self._minute(int(minute))
+            entry['frames'] += int(rows.sum())
+            entry['power'] += power[rows].sum(axis=0)
+            entry['aci_diff'] += diffs[rows].sum(axis=0)
+            entry['square_sum'] += float(square_sums[rows].sum())
+            entry['peak'] = max(entry['peak'], float(peaks[rows].max()))
+
+    def result(self):
+        """ The summary as a dict of arrays, one row per minute """
+        import numpy as np
+
+        minutes = [self.minutes[m] for m in sorted(self.minutes)]
+        frames = np.array([m['frames'] for m in minutes], dtype='float64')
+        power = np.array([m['power'] for m in minutes]).reshape(len(minutes), -1)
+        aci_diff = np.array([m['aci_diff'] for m in minutes]).reshape(len(minutes), self.n_bands)
+        eps = 1e-12
+
+        bands = power[:, :self.n_bands]
+        mean_bands = bands / np.maximum(frames, 1)[:, np.newaxis]
+        p = mean_bands / np.maximum(mean_bands.sum(axis=1, keepdims=True), eps)
+        anthro, bio = power[:, self.n_bands], power[:, self.n_bands + 1]
+
+        return {
+            'samplerate': np.array(self.samplerate),
+            'minute_start_s': np.array(sorted(self.minutes), dtype='float32') * self.frames_per_minute * self.nfft / self.samplerate,
+            'band_edges_hz': self.band_edges.astype('float32'),
+            'band_db': (10 * np.log10(mean_bands + eps)).astype('float16'),
+            'rms_db': (10 * np.log10(np.array([m['square_sum'] for m in minutes]) / np.maximum(frames * self.nfft, 1) / 32768 ** 2 + eps)).astype('float16'),
+            'peak_db': (20 * np.log10(np.array([m['peak'] for m in minutes]) / 32768 + eps)).astype('float16'),
+            'aci': (aci_diff / np.maximum(bands, eps)).sum(axis=1).astype('float32'),
+            'entropy': (-(p * np.log(np.maximum(p, eps))).sum(axis=1) / np.log(self.n_bands)).astype('float32'),
+            'ndsi': ((bio - anthro) / np.maximum(bio + anthro, eps)).astype('float32'),
+        }
+
+    def write(self, path):
+        """ Save the summary to path as a compressed .npz """
+        import numpy as np
+
+        # Through a hidden temporary file, so a half written summary is never picked up for upload
+        with atomic_write(path, 'wb', hidden=True) as f:
+            np.savez_compressed(f, **self.result())
@@ -0,0 +1,151 @@
+"""
+Telemetry, one snapshot of the device's state per wake.
+
+Each snapshot holds the uptime, signal strength, SIM CCID, CPU temperature, free space on the USB,
+the backlog still waiting to be converted and uploaded, and the conversion and upload throughput of
+this boot (from the timing spans). All the AT queries go through one modem session.
+
+Snapshots are appended to a small CSV file, capped at TELEMETRY_MAX_RECORDS so it can't grow forever
+while there's no connection. The file is bundled with the logs and cleared on the next sync.
+"""
+
+import csv
+import logging
+import os
+import shutil
+import time
+
+from .atomic import atomic_write
+from .utils import get_sys_uptime
+from .timing import timings
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+TELEMETRY_PATH = '/home/src/telemetry.csv'
+
+# Oldest snapshots are dropped past this, about two months of one wake a day
+TELEMETRY_MAX_RECORDS = 64
+
+CPU_TEMP_PATH = '/sys/class/thermal/thermal_zone0/temp'
+
+FIELDS = ['time', 'uptime_s', 'rssi', 'rssi_dbm', 'sim_ccid', 'cpu_temp_c', 'usb_free_mb',
+          'wav_backlog', 'upload_backlog', 'convert_bytes_per_s', 'upload_bytes_per_s']
+
+def get_cpu_temp():
+    """ CPU temperature in degrees C, or None if it can't be read """
+    try:
+        with open(CPU_TEMP_PATH) as f:
+            return int(f.read()) / 1000
+    except (OSError, ValueError):
+        return None
+
+def get_modem_status(modem):
+    """ RSSI, RSSI in dBm and SIM CCID, read in a single AT session. Any that can't be read are None """
+    rssi = ccid = None
+    try:
+        with modem.at_session():
+            rssi = modem.get_rssi()
+            ccid = modem.get_sim_ccid()
+    except Exception as e:
+        logger.info('Could not read modem status for telemetry: %s', e)
+
+    # Same conversion as Modem.get_rssi_dbm, without sending AT+CSQ again
+    rssi_dbm = -113 + 2 * rssi if rssi is not None and rssi != 99 else None
+    return rssi, rssi_dbm, ccid
+
+def get_throughput(span_name):
+    """
+    Bytes per second over all spans of this boot with span_name, or None if there were none.
+    Spans run in parallel (upload threads, conversion workers), so the time is the union of
+    their intervals rather than the sum of their wall times.
+    """
+    with timings.lock:
+        records = [r for r in timings.records if r['span'] == span_name and r.get('bytes') and 'error' not in r]
+
+    wall = 0
+    end = None
+    for (start, stop) in sorted((r['t'], r['t'] + r['wall_s']) for r in records):
+        if end is None or start > end:
+            wall += stop - start
+            end = stop
+        elif stop > end:
+            wall += stop - end
+            end = stop
+    if not wall:
+        return None
+    return round(sum(r['bytes'] for r in records) / wall)
+
+def snapshot(modem, usb_dir=None, wav_dir=None, index=None):
+    """ Collect one telemetry snapshot as a dict with the keys in FIELDS """
+    rssi, rssi_dbm, ccid = get_modem_status(modem)
+
+    usb_free_mb = None
+    if usb_dir:
+        usb_free_mb = round(shutil.disk_usage(usb_dir).free / 1024 / 1024)
+
+    wav_backlog = None
+    if wav_dir and os.path.isdir(wav_dir):
+        wav_backlog = sum(1 for f in os.listdir(wav_dir) if f.lower().endswith('.wav'))
+
+    return {
+        'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'uptime_s': round(get_sys_uptime(), 1),
+        'rssi': rssi,
+        'rssi_dbm': rssi_dbm,
+        'sim_ccid': ccid,
+        'cpu_temp_c': get_cpu_temp(),
+        'usb_free_mb': usb_free_mb,
+        'wav_backlog': wav_backlog,
+        'upload_backlog': len(index.pending()) if index is not None else None,
+        'convert_bytes_per_s': get_throughput('convert'),
+        'upload_bytes_per_s': get_throughput('upload'),
+    }
+
+def append_record(record, path, max_records=None):
+    """ Append a snapshot to the CSV at path, dropping the oldest rows past max_records (TELEMETRY_MAX_RECORDS by default) """
+    max_records = max_records or TELEMETRY_MAX_RECORDS
+    rows = []
+    if os.path.exists(path):
+        with open(path, newline='') as f:
+            rows = list(csv.DictReader(f))
+
+    if len(rows) < max_records:
+        # The common case is a plain append
+        new_file = not rows
+        with open(path, 'a', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=FIELDS)
+            if new_file:
+                writer.writeheader()
+            writer.writerow(record)
+        return
+
+    rows = rows[len(rows) - max_records + 1:] + [record]
+    with atomic_write(path, newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=FIELDS)
+        writer.writeheader()
+        writer.writerows(rows)
+
+def last_rssi_dbm(path=None):
+    """ Signal strength in dBm from the most recent snapshot that has one, or None """
+    try:
+        with open(path or TELEMETRY_PATH, newline='') as f:
+            rows = list(csv.DictReader(f))
+    except OSError:
+        return None
+
+    for row in reversed(rows):
+        if row.get('rssi_dbm'):
+            return int(row['rssi_dbm'])
+    return None
+
+def record_snapshot(modem, usb_dir=None, wav_dir=None, index=None, path=None):
+    """ Collect a snapshot and append it to the telemetry file. Never raises, telemetry mustn't stop an upload """
+    try:
+        record = snapshot(modem, usb_dir, wav_dir, index)
+        append_record(record, path or TELEMETRY_PATH)
+        logger.info('Telemetry: %s', record)
+        return record
+    except Exception as e:
+        logger.error('Could not record telemetry: %s', e)
+        return None
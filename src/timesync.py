@@ -0,0 +1,217 @@
+"""
+Keeping the clock right without holding up the uploads.
+
+The RPi is off most of the time and sets its clock from the RTC module at boot. Once there's a
+connection the sync runs on a background thread while the uploads carry on:
+
+    from .timesync import start_sync
+
+    task = start_sync()
+    ...
+    result = task.result() # {'skipped': False, 'offset': 0.42, 'server': 'ntp.ubuntu.com', ...}
+
+Each sync is a single SNTP exchange (RFC 4330) with a short timeout, trying the next server only if one
+doesn't answer. The offsets measured are kept in a small JSON state file along with when the RTC was
+last written, giving the drift rate of the RTC in ppm. When the drift predicted since the last write
+is under MAX_PREDICTED_OFFSET the network isn't used at all, though the clock is still checked at least
+every MAX_SYNC_INTERVAL to keep the drift rate up to date.
+
+The system clock is stepped if it's more than CLOCK_STEP_THRESHOLD out, and the RTC is only written
+(hwclock -w) if the correction is more than RTC_WRITE_THRESHOLD.
+"""
+
+import json
+import logging
+import socket
+import struct
+import time
+
+from .atomic import atomic_write
+from .commands import run, submit
+from .timing import span
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+NTP_SERVERS = ['ntp.ubuntu.com', 'pool.ntp.org']
+NTP_PORT = 123
+SNTP_TIMEOUT = 3 # seconds per server
+
+STATE_PATH = '/home/src/timesync.json'
+HISTORY_LENGTH = 20 # syncs kept in the state file
+
+# Skip the network sync while the RTC is predicted to be less than this out
+MAX_PREDICTED_OFFSET = 1.0 # seconds
+MAX_SYNC_INTERVAL = 7 * 24 * 3600 # seconds
+
+# The drift rate is only measured over at least this long, shorter gaps are mostly measurement error
+MIN_DRIFT_INTERVAL = 3600 # seconds
+DRIFT_SMOOTHING = 0.3
+
+CLOCK_STEP_THRESHOLD = 0.05 # seconds
+RTC_WRITE_THRESHOLD = 0.5 # seconds, hwclock only sets whole seconds anyway
+
+COMMAND_TIMEOUT = 10 # seconds
+
+# Seconds from the NTP epoch (1900) to the Unix epoch (1970)
+NTP_DELTA = 2208988800
+
+def _to_ntp(t):
+    seconds = int(t + NTP_DELTA)
+    return seconds, int((t + NTP_DELTA - seconds) * 2 ** 32) & 0xffffffff
+
+def _from_ntp(seconds, fraction):
+    return seconds - NTP_DELTA + fraction / 2 ** 32
+
+def sntp_query(server, timeout=SNTP_TIMEOUT):
+    """
+    One SNTP request to server.
+
+    Returns:
+        (offset, delay) in seconds, offset is how far the system clock is behind the server
+    Raises:
+        OSError if the server can't be reached or gives a bad reply
+    """
+    address = socket.getaddrinfo(server, NTP_PORT, type=socket.SOCK_DGRAM)[0]
+    with socket.socket(address[0], socket.SOCK_DGRAM) as sock:
+        sock.settimeout(timeout)
+
+        # Version 4, client mode. The transmit time comes back as the originate time, so the reply can be matched
+        t1 = time.time()
+        transmit = _to_ntp(t1)
+        request = struct.pack('!B47x', 0x23)[:40] + struct.pack('!II', *transmit)
+        sock.sendto(request, address[4])
+
+        while True:
+            reply, _ = sock.recvfrom(512)
+            t4 = time.time()
+            if len(reply) >= 48 and struct.unpack('!II', reply[24:32]) == transmit:
+                break
+
+    mode = reply[0] & 0x7
+    leap = reply[0] >> 6
+    stratum = reply[1]
+    if mode != 4 or leap == 3 or not 1 <= stratum <= 15:
+        raise OSError(f'Unusable SNTP reply from {server} (mode {mode}, leap {leap}, stratum {stratum})')
+
+    t2 = _from_ntp(*struct.unpack('!II', reply[32:40]))
+    t3 = _from_ntp(*struct.unpack('!II', reply[40:48]))
+    offset = ((t2 - t1) + (t3 - t4)) / 2
+    delay = (t4 - t1) - (t3 - t2)
+    return offset, delay
+
+def query_servers(servers=NTP_SERVERS, timeout=SNTP_TIMEOUT):
+    """ Ask each server in turn until one answers. Returns (server, offset, delay) """
+    error = None
+    for server in servers:
+        try:
+            offset, delay = sntp_query(server, timeout)
+            return server, offset, delay
+        except OSError as e:
+            logger.info('No time from %s: %s', server, e)
+            error = e
+    raise OSError(f'None of {", ".join(servers)} answered') from error
+
+def load_state(path=None):
+    """ The sync history from the state file, or an empty one """
+    try:
+        with open(path or STATE_PATH) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError) as e:
+        logger.error('Could not read time sync state, starting again. %s', e)
+        return {}
+
+def save_state(state, path=None):
+    path = path or STATE_PATH
+    try:
+        with atomic_write(path) as f:
+            json.dump(state, f)
+    except OSError as e:
+        logger.error('Could not save time sync state. %s', e)
+
+def predicted_offset(state, now=None):
+    """ How far out the RTC is expected to be by now in seconds, or None if there's no drift rate yet """
+    now = time.time() if now is None else now
+    if state.get('drift_ppm') is None or state.get('rtc_set') is None:
+        return None
+    elapsed = now - state['rtc_set']
+    if elapsed < 0:
+        # The clock is behind the last write, the RTC has most likely lost its battery
+        return None
+    return abs(state['drift_ppm']) * 1e-6 * elapsed
+
+def needs_sync(state, now=None):
+    """ True if the clock should be checked against the network. Returns (needed, predicted offset) """
+    now = time.time() if now is None else now
+    predicted = predicted_offset(state, now)
+    if predicted is None or predicted >= MAX_PREDICTED_OFFSET:
+        return True, predicted
+    return now - state.get('last_sync', 0) >= MAX_SYNC_INTERVAL, predicted
+
+def update_drift(state, offset, now):
+    """ Fold a measured offset into the drift rate of the RTC, counted from when it was last written """
+    if state.get('rtc_set') is None:
+        return
+    elapsed = now - state['rtc_set']
+    if elapsed < MIN_DRIFT_INTERVAL:
+        return
+    rate = offset / elapsed * 1e6
+    if state.get('drift_ppm') is None:
+        state['drift_ppm'] = rate
+    else:
+        state['drift_ppm'] += DRIFT_SMOOTHING * (rate - state['drift_ppm'])
+
+def step_clock(offset):
+    """ Move the system clock forward by offset seconds """
+    result = run(['sudo', 'date', '-u', '-s', '@{:.3f}'.format(time.time() + offset)], timeout=COMMAND_TIMEOUT)
+    return result.ok
+
+def write_rtc():
+    """ Copy the system clock to the RTC module """
+    result = run(['sudo', 'hwclock', '-w'], timeout=COMMAND_TIMEOUT)
+    return result.ok
+
+def sync(servers=NTP_SERVERS, timeout=SNTP_TIMEOUT, path=None, force=False):
+    """
+    Check the clock against the network if it's needed and correct the system clock and RTC.
+    Never raises, any error is logged and returned in the result.
+
+    Returns:
+        A dict of what happened: skipped, predicted, server, offset, delay, stepped, rtc_written and error
+    """
+    with span('time_sync') as record:
+        try:
+            state = load_state(path)
+            needed, predicted = needs_sync(state)
+            record.update({'skipped': not (needed or force), 'predicted': predicted and round(predicted, 3)})
+            if not (needed or force):
+                logger.info('Skipping time sync, the RTC should be within %.2fs (%.2f ppm)', predicted, state['drift_ppm'])
+                return record
+
+            server, offset, delay = query_servers(servers, timeout)
+            logger.info('Clock is %.3fs behind %s (round trip %.3fs)', offset, server, delay)
+            record.update({'server': server, 'offset': round(offset, 4), 'delay': round(delay, 4)})
+
+            record['stepped'] = abs(offset) >= CLOCK_STEP_THRESHOLD and step_clock(offset)
+            now = time.time() if record['stepped'] else time.time() + offset
+
+            update_drift(state, offset, now)
+            record['rtc_written'] = (abs(offset) >= RTC_WRITE_THRESHOLD or state.get('rtc_set') is None) and write_rtc()
+            if record['rtc_written']:
+                logger.info('Wrote the corrected time to the RTC')
+                state['rtc_set'] = now
+
+            state['last_sync'] = now
+            state['history'] = (state.get('history', []) + [{'t': round(now), 'offset': round(offset, 4), 'delay': round(delay, 4),
+                                                             'rtc_written': record['rtc_written']}])[-HISTORY_LENGTH:]
+            save_state(state, path)
+        except Exception as e:
+            logger.error('Time sync failed: %s', e)
+            record['error'] = str(e)
+        return record
+
+def start_sync(**kwargs):
+    """ Run sync() in the background with the same arguments. Returns a Future of its result """
+    return submit(sync, **kwargs)
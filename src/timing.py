@@ -0,0 +1,106 @@
+"""
+Timed spans around the stages of a wake cycle, written out as one JSON line per span.
+
+    from .timing import span
+
+    with span('upload', file=local_path, bytes=size):
+        ...
+
+Each span records its start time, wall time, CPU time of the thread it ran on, bytes processed and
+throughput (if given), and the RSS of the process when it ended. Spans on the main thread also record
+the peak RSS while they ran: the kernel's high-water mark (VmHWM) is reset when one starts, and the
+peak so far is carried over to the spans enclosing it. Spans on other threads have no peak of their
+own, since a main-thread span can reset the mark while they run.
+
+main() writes the spans of each boot to a .timing.jsonl file in the log directory, which is uploaded
+with the logs on the next sync.
+"""
+
+import json
+import threading
+import time
+from contextlib import contextmanager
+
+def _memory_mb():
+    """ Current and peak RSS of this process in MB, from /proc/self/status """
+    rss = peak = None
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    rss = int(line.split()[1]) / 1024
+                elif line.startswith('VmHWM:'):
+                    peak = int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return rss, peak
+
+def _reset_peak():
+    """ Reset the peak RSS of this process to its current RSS. Not every kernel allows it, which is fine """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+class Timings:
+    """ Collects the spans of one boot. Spans can be recorded from any thread """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.records = []
+        self.open_peaks = [] # Peak RSS so far of each open main-thread span, innermost last
+
+    @contextmanager
+    def span(self, name, **fields):
+        """
+        Time the code inside the with block. fields are stored with the span, and the yielded dict
+        can be updated inside the block, e.g. record['bytes'] = n once the size is known.
+        """
+        record = {'span': name, 't': round(time.time(), 3)}
+        record.update(fields)
+        main = threading.current_thread() is threading.main_thread()
+        if main:
+            #The enclosing spans would lose their peak so far when it's reset
+            _, peak = _memory_mb()
+            self.open_peaks = [max(p, peak or 0) for p in self.open_peaks] + [0]
+            _reset_peak()
+        wall_start = time.monotonic()
+        cpu_start = time.thread_time()
+
+        try:
+            yield record
+        except BaseException as e:
+            record['error'] = str(e)
+            raise
+        finally:
+            wall = time.monotonic() - wall_start
+            record['wall_s'] = round(wall, 3)
+            record['cpu_s'] = round(time.thread_time() - cpu_start, 3)
+            if record.get('bytes'):
+                record['bytes_per_s'] = round(record['bytes'] / max(wall, 1e-6))
+            rss, peak = _memory_mb()
+            record['rss_mb'] = rss and round(rss, 1)
+            if main:
+                peak = max(self.open_peaks.pop(), peak or 0)
+                if self.open_peaks:
+                    self.open_peaks[-1] = max(self.open_peaks[-1], peak)
+                record['peak_rss_mb'] = peak and round(peak, 1)
+            self.add(record)
+
+    def add(self, record):
+        """ Add a finished span, e.g. one recorded in a worker process """
+        with self.lock:
+            self.records.append(record)
+
+    def write(self, path):
+        """ Append every span recorded so far to path as JSON lines, and clear them """
+        with self.lock:
+            records, self.records = self.records, []
+
+        with open(path, 'a') as f:
+            for record in records:
+                f.write(json.dumps(record, separators=(',', ':')) + '\n')
+
+# Shared by the whole process
+timings = Timings()
+span = timings.span
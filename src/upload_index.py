@@ -0,0 +1,207 @@
+"""
+Persistent index of the files on the USB that need uploading.
+
+Files are added to the index when they are created (converted FLACs, rotated logs) instead of being
+found by walking the whole USB on every sync. Each entry records the path, size, mtime, MD5 and
+upload state, so a sync is a query for pending files and re-running after a crash is safe.
+The index is an SQLite database kept on the USB next to the files it describes.
+
+Files whose MD5 was already worked out when they were written (converted FLACs) have it in a hidden
+checksum sidecar, which the index takes instead of reading the file again.
+"""
+
+import base64
+import hashlib
+import io
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+PENDING = 'pending'
+UPLOADED = 'uploaded'
+BUNDLED = 'bundled'
+MISSING = 'missing'
+
+HASH_READ_SIZE = 1024 * 1024
+
+CHECKSUM_SUFFIX = '.md5'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime REAL NOT NULL,
+    md5 TEXT,
+    state TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    error TEXT,
+    added REAL NOT NULL,
+    uploaded REAL
+);
+CREATE INDEX IF NOT EXISTS files_state ON files (state, added);
+"""
+
+def file_md5(path):
+    """ Base64 MD5 of a file, in the same format GCS uses for md5Hash """
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for data in iter(lambda: f.read(HASH_READ_SIZE), b''):
+            md5.update(data)
+    return base64.b64encode(md5.digest()).decode()
+
+class HashingReader(io.FileIO):
+    """
+    A file opened for reading that takes the MD5 of its bytes while something else reads it,
+    e.g. a decoder. Reads that go back over bytes already hashed are fine, skipping ahead isn't.
+    """
+    def __init__(self, path):
+        super().__init__(path, 'rb')
+        self.md5 = hashlib.md5()
+        self.hashed = 0
+
+    def readinto(self, buffer):
+        start = self.tell()
+        n = super().readinto(buffer)
+        if n and start <= self.hashed < start + n:
+            self.md5.update(memoryview(buffer)[self.hashed - start:n])
+            self.hashed = start + n
+        return n
+
+    def b64digest(self):
+        """ Base64 MD5 of the whole file, or None if it wasn't read through to the end in order """
+        if self.hashed != os.fstat(self.fileno()).st_size:
+            return None
+        return base64.b64encode(self.md5.digest()).decode()
+
+def checksum_path(path):
+    """ Path of the hidden checksum sidecar of a file """
+    directory, name = os.path.split(path)
+    return os.path.join(directory, '.' + name + CHECKSUM_SUFFIX)
+
+def write_checksum(path, md5):
+    """ Save the base64 MD5 of path in its sidecar, along with the size and mtime it belongs to """
+    stat = os.stat(path)
+    entry = {'md5': md5, 'size': stat.st_size, 'mtime': stat.st_mtime}
+    with open(checksum_path(path), 'w') as f:
+        json.dump(entry, f)
+
+def read_checksum(path):
+    """ The MD5 saved in the sidecar of path, or None if there isn't one or the file has changed since """
+    try:
+        with open(checksum_path(path)) as f:
+            entry = json.load(f)
+        stat = os.stat(path)
+    except (OSError, ValueError):
+        return None
+
+    if (entry.get('size'), entry.get('mtime')) != (stat.st_size, stat.st_mtime):
+        return None
+    return entry.get('md5')
+
+def remove_checksum(path):
+    """ Delete the sidecar of path, if it has one """
+    try:
+        os.remove(checksum_path(path))
+    except FileNotFoundError:
+        pass
+
+class UploadIndex:
+    """
+    SQLite backed record of every file that has been queued for upload and what happened to it.
+    The connection is shared between the upload threads, so every query holds the lock.
+    """
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.created = not os.path.exists(db_path)
+        self.lock = threading.Lock()
+
+        self.db = sqlite3.connect(db_path, check_same_thread=False)
+        self.db.executescript(SCHEMA)
+        self.db.commit()
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+    def add(self, path, md5=None):
+        """
+        Add a file as pending. A file that is already indexed is only reset to pending if its size or
+        mtime has changed since, so adding the same file twice doesn't upload it twice.
+        If md5 isn't given it's taken from the file's checksum sidecar, or worked out if there isn't one.
+        The sidecar is removed once the index has the MD5.
+        """
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+
+        with self.lock:
+            row = self.db.execute('SELECT size, mtime FROM files WHERE path = ?', (path,)).fetchone()
+        if row == (stat.st_size, stat.st_mtime):
+            remove_checksum(path)
+            return
+
+        if md5 is None:
+            md5 = read_checksum(path) or file_md5(path)
+
+        with self.lock:
+            self.db.execute('INSERT OR REPLACE INTO files (path, size, mtime, md5, state, added) VALUES (?, ?, ?, ?, ?, ?)',
+                            (path, stat.st_size, stat.st_mtime, md5, PENDING, time.time()))
+            self.db.commit()
+        remove_checksum(path)
+
+    def scan(self, root, skip_suffixes=()):
+        """
+        Add every file under root that isn't indexed yet.
+        Only needed to adopt files that were on the USB before the index existed.
+        Hidden files (like the index itself), the old 'uploaded' archive and files ending in skip_suffixes are skipped.
+        """
+        for dirpath, dirnames, files in os.walk(root):
+            dirnames[:] = [d for d in dirnames if not d.startswith('.') and d != 'uploaded']
+            for f in files:
+                if not f.startswith('.') and not f.lower().endswith(skip_suffixes):
+                    self.add(os.path.join(dirpath, f))
+
+        logger.info('Indexed existing files under %s', root)
+
+    def pending(self):
+        """ Paths of files still waiting to be uploaded, oldest first """
+        with self.lock:
+            rows = self.db.execute('SELECT path FROM files WHERE state = ? ORDER BY added', (PENDING,)).fetchall()
+        return [path for (path,) in rows]
+
+    def get(self, path):
+        """ Return the index entry for path as a dict, or None if it isn't indexed """
+        with self.lock:
+            cursor = self.db.execute('SELECT * FROM files WHERE path = ?', (os.path.abspath(path),))
+            row = cursor.fetchone()
+            if row is None:
+                return None
+            return dict(zip([c[0] for c in cursor.description], row))
+
+    def mark_uploaded(self, path):
+        with self.lock:
+            self.db.execute('UPDATE files SET state = ?, uploaded = ?, error = NULL WHERE path = ?',
+                            (UPLOADED, time.time(), os.path.abspath(path)))
+            self.db.commit()
+
+    def mark_bundled(self, paths):
+        """ Record that paths were packed into a bundle, which is now uploaded in their place """
+        with self.lock:
+            self.db.executemany('UPDATE files SET state = ? WHERE path = ?',
+                                [(BUNDLED, os.path.abspath(path)) for path in paths])
+            self.db.commit()
+
+    def mark_failed(self, path, error):
+        """ Record a failed attempt. The file stays pending unless it has disappeared from the USB """
+        path = os.path.abspath(path)
+        state = PENDING if os.path.exists(path) else MISSING
+
+        with self.lock:
+            self.db.execute('UPDATE files SET state = ?, attempts = attempts + 1, error = ? WHERE path = ?',
+                            (state, error, path))
+            self.db.commit()
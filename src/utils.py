@@ -9,15 +9,30 @@ import os
 import logging
 import shutil
 import json
-import RPi.GPIO as GPIO
+import hashlib
+import re
 import time
-import requests
-import soundfile as sf
 import datetime as dt
-
-from google.cloud import storage
-from drivers.modem import Modem
-from .logs import Log
+import queue
+import socket
+import threading
+import multiprocessing
+
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+
+#The heavy libraries (soundfile, numpy, google-cloud-storage, requests, RPi.GPIO and the modem driver)
+#are imported inside the functions that use them, so each boot only pays for the stages it actually runs
+from .atomic import atomic_write
+from .resumable import UploadJournal, resumable_upload
+from .upload_index import UploadIndex, HashingReader, file_md5, write_checksum, read_checksum, remove_checksum
+from .scheduler import UploadScheduler
+from .bundle import make_bundles
+from .timing import Timings, timings, span
+from .commands import run, start, run_many
+from .timesync import start_sync
+from .encoding import get_profile, select_profile, load_stats, save_stats, update_stats, reduce_bit_depth, Decimator
+from .activity import ActivityGate, activity_index_path
+from .summary import SummaryAccumulator, summary_path, SUMMARY_SUFFIX
 
 # Create a logger for this module and set its level
 logger = logging.getLogger(__name__)
@@ -26,70 +41,193 @@ logger.setLevel(logging.INFO)
 # How many times to try for an internet connection before starting recording
 connection_retries = 30 #Can be changed if another amount of retries is preferred
 
+#Host and port the connection is checked against, uploads go to GCS so that's the route that has to work
+probe_host = 'storage.googleapis.com'
+probe_port = 443
+#Returns an empty 204 response, only fetched if check_internet_conn is asked for an HTTP check
+probe_204_url = 'http://connectivitycheck.gstatic.com/generate_204'
+
+#Wait between connection checks, doubling from the first to the last
+connection_backoff_min = 0.25 #seconds
+connection_backoff_max = 1 #seconds
+
+#Common paths the USB might be mounted on, can add more if unsure where it is mounted
+usb_dirs = ['/mnt/x']
+
+#Number of files uploaded at the same time, each one is its own stream over the shared GCS client
+upload_workers = 4 #Keep at or below 10, the size of the client's HTTP connection pool
+
+#Upload files in resumable chunks so a dropped link only loses the chunk that was being sent
+resumable_uploads = True
+upload_chunk_size = 1024 * 1024 #bytes, rounded down to a multiple of 256 KiB. Smaller chunks lose less on a bad link
+
+#Where unfinished resumable uploads are remembered between boots
+upload_journal_path = '/home/src/upload_journal.json'
+
+#Keep track of files to upload in an index on the USB instead of walking the whole USB and archiving every file
+use_upload_index = True
+upload_index_name = '.upload_index.db' #Hidden so it's never picked up as a file to upload
+delete_uploaded = True #Delete files from the USB once the index has them marked as uploaded
+
+#Pack files smaller than bundle_threshold into tars of up to bundle_target_size, so each small file doesn't cost its own request
+bundle_small_files = True
+bundle_threshold = 256 * 1024 #bytes
+bundle_target_size = 8 * 1024 * 1024 #bytes
+
+#Longest time the modem may stay on for connecting and uploading, no upload is started that isn't expected to finish in time
+upload_time_budget = 10 * 60 #seconds, None for no limit
+upload_policy = 'priority' #'priority' (telemetry, summaries and logs first, then smallest), 'newest', 'oldest' or 'smallest'
+
+#Append a snapshot of uptime, signal, temperature, disk space, backlog and throughput to the telemetry file every wake
+collect_telemetry = True
+
 #GPIO pin to signal shutdown
 Shutdown_GPIO_pin = 17
 
-def call_cmd_line(args, use_shell=True, print_output=False, run_in_bg=False):
+#Detect acoustic activity while converting (see activity.py), None keeps all the audio,
+#'trim' only keeps the active parts and 'drop' keeps whole recordings but deletes those with no activity at all
+activity_detection = None
+
+#Write a few kilobytes of acoustic summary per recording (see summary.py), uploaded before the audio itself
+acoustic_summaries = True
+
+#Decode each FLAC after converting it and only delete the WAV if it holds exactly the same samples
+verify_flac = True
+
+#Number of frames read and encoded at a time when streaming WAV to FLAC, unless the profile sets its own
+flac_blocksize = 65536 #Peak memory is roughly blocksize * channels * 2 bytes
+
+#FLAC encoding profile from encoding.PROFILES, or 'auto' to pick one each wake from the measured encoder speed, signal strength and backlog
+flac_profile = 'auto'
+allow_lossy_profiles = False #Let 'auto' choose profiles that reduce the bit depth or sample rate
+profile_stats_path = '/home/src/flac_profile_stats.json' #Measured speed and compression ratio of each profile
+
+#Number of processes used to convert wav files, the CM4 has four cores
+conversion_workers = 4
+
+#Upper limit on memory used by all conversion workers together, fewer workers are started if they wouldn't fit
+conversion_memory_limit = 256 * 1024 * 1024 #bytes
+
+#Rough memory used by each worker process on top of its block buffer (interpreter, numpy and libsndfile)
+worker_memory_overhead = 40 * 1024 * 1024 #bytes
+
+#Longest a system command (nmcli, hwclock...) may run before it's stopped, so a hung one can't hold up the wake cycle
+command_timeout = 20 #seconds
+ntp_timeout = 3 #seconds per SNTP server, the time sync runs alongside the uploads (see timesync.py)
+time_sync_wait = 15 #seconds to wait for an unfinished time sync before the modem is turned off
+time_sync_task = None
+
+#Add the mobile_network profile from the credentials file to NetworkManager if needed, and bring it up as soon as the modem is on
+provision_network_profile = True
+network_profile_name = 'mobile'
+network_profile_cache_path = '/home/src/network_profile_cache.json' #UUID of the profile for each fingerprint of its settings
+network_activation_timeout = 90 #seconds
+
+def call_cmd_line(args, use_shell=True, print_output=False, run_in_bg=False, timeout=None):
 
     """
-    Use command line calls - wrapper around subprocess.Popen
+    Use command line calls - wrapper around commands.run, kept for the old callers.
+    Returns the output with each line stripped and joined together, as it always has.
+    With run_in_bg the command carries on in the background and a Future of its CommandResult is returned.
     """
-    p = subprocess.Popen(args, stdout=subprocess.PIPE, shell=use_shell, encoding='utf8')
-    if run_in_bg: return
+    if timeout is None:
+        timeout = command_timeout
 
-    res = ''
-    while True:
-        output = p.stdout.readline()
-        if output == '' and p.poll() is not None:
-            break
-        if output:
-            res = res + output.strip()
-            if print_output: logger.info(output.strip())
-
-    rc = p.poll()
+    if run_in_bg:
+        return start(args, timeout, shell=use_shell, log_output=print_output)
 
-    return res
+    result = run(args, timeout, shell=use_shell, log_output=print_output)
+    return ''.join(line.strip() for line in result.output.splitlines())
 
 def update_time():
-    # Updates time from the internet since the RPi is turned off most of the time
-    # Read time from real-time clock module
-    # logger.info('Reading time from RTC')
-    # call_cmd_line('sudo hwclock -r')
-
-    # Update time from internet
-    logger.info('Updating time from internet before GCS sync')
-    cmd_res = call_cmd_line('sudo timeout 180s ntpdate ntp.ubuntu.com')
+    """
+    Start updating the time from the internet in the background, since the RPi is turned off most of the time.
+    The network is only used if the RTC may have drifted too far, see timesync.py.
 
-    # Check if ntpdate was successful
-    if 'adjust time server' in cmd_res:
-        # Update time on real-time clock module
-        logger.info('Writing updated time to RTC')
-        call_cmd_line('sudo hwclock -w')
+    Returns:
+        A Future of the sync result
+    """
+    global time_sync_task
+    time_sync_task = start_sync(timeout=ntp_timeout)
+    return time_sync_task
+
+def wait_for_time_sync(timeout=None):
+    """ Wait for the time sync started by update_time() to finish, so the modem isn't turned off in the middle of it """
+    if time_sync_task is None:
+        return None
+    try:
+        return time_sync_task.result(time_sync_wait if timeout is None else timeout)
+    except Exception as e:
+        logger.info('Time sync still running when the modem was turned off: {}'.format(str(e) or type(e).__name__))
+        return None
 
-def check_internet_conn(timeout=2):
+def has_default_route():
     """
-    Check if there is a valid internet connection by fetching the entire content of Google's homepage and print the number of bytes.
+    Check the kernel routing table for a default route. This costs nothing over the air,
+    and until the modem's interface has one there's no point trying the network.
     """
     try:
-        # Use the requests library to handle the connection and automatically follow redirects
-        response = requests.get('http://www.google.com', timeout=timeout)
-        
-        # Check if the request was successful (status code 200)
-        if response.status_code == 200:
-            content_length = len(response.content)  # Get the number of bytes in the response content
-            logger.debug("Successfully fetched Google's homepage. Content size: %s bytes.", content_length)
-        else:
-            logger.debug("Failed to fetch Google's homepage. Status code: %s", response.status_code)
+        with open('/proc/net/route') as f:
+            next(f) #Skip header
+            for line in f:
+                fields = line.split()
+                #Destination 00000000 is the default route, flag 0x1 means it's up
+                if fields[1] == '00000000' and int(fields[3], 16) & 0x1:
+                    return True
+    except (OSError, IndexError, ValueError) as e:
+        logger.debug("Could not read routing table: %s", e)
+    return False
+
+def probe_tcp(host, port, timeout=2):
+    """
+    Resolve host and open a TCP connection to it, only a DNS lookup and a handshake are sent.
+    """
+    try:
+        with socket.create_connection((host, port), timeout=timeout):
+            return True
+    except OSError as e:
+        logger.debug("TCP connection to %s:%s failed: %s", host, port, e)
+        return False
+
+def probe_http_204(url, timeout=2):
+    """ Fetch an endpoint that answers with an empty 204 response, to detect captive portals """
+    import requests
+
+    try:
+        response = requests.get(url, timeout=timeout, allow_redirects=False)
+        return response.status_code == 204
     except Exception as e:
-        logger.debug("An error occurred: %s", e)
+        logger.debug("HTTP check of %s failed: %s", url, e)
+        return False
+
+def check_internet_conn(timeout=2, use_http=False):
+    """
+    Check if there is a valid internet connection, with the cheapest checks first:
+    a default route, then DNS and a TCP handshake with GCS, then optionally an HTTP 204 check.
+
+    Returns:
+        True if every check passed, False otherwise
+    """
+    if not has_default_route():
+        logger.debug("No default route yet")
+        return False
+
+    if not probe_tcp(probe_host, probe_port, timeout=timeout):
+        return False
+
+    if use_http and not probe_http_204(probe_204_url, timeout=timeout):
         return False
+
+    return True
     
 def wait_for_connection(n_tries, timeout=2, verbose=False):
     """
-    Repeatedly check and wait for a valid internet conntection
+    Repeatedly check and wait for a valid internet conntection.
+    The wait between checks starts short and doubles, so a connection that comes up quickly is found quickly.
     """
 
     is_conn = False
+    backoff = connection_backoff_min
 
     logging.info('Waiting for internet connection...')
 
@@ -101,11 +239,12 @@ def wait_for_connection(n_tries, timeout=2, verbose=False):
         if is_conn:
             break
 
-        # Otherwise sleep for a second and try again
+        # Otherwise wait a little longer each time and try again
         else:
             if verbose:
                 logging.info('No internet connection on try {}/{}'.format(n_try+1, n_tries))
-            time.sleep(1)
+            time.sleep(backoff)
+            backoff = min(backoff * 2, connection_backoff_max)
 
     if is_conn:
         logging.info('Connected to the Internet')
@@ -115,44 +254,130 @@ def wait_for_connection(n_tries, timeout=2, verbose=False):
 
     return is_conn
 
-def add_network_profile(name, apn, username, password):
-    """ Add a new GSM connection profile to NetworkManager if there isn't already one with the same apn, username and password. """
-   
+def network_fingerprint(apn, username, password):
+    """ SHA-256 of the profile settings, so the cache can tell if they've changed without holding the password itself """
+    return hashlib.sha256('\0'.join([apn or '', username or '', password or '']).encode()).hexdigest()
+
+def _load_profile_cache():
+    try:
+        with open(network_profile_cache_path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def _save_profile_cache(cache):
+    try:
+        with atomic_write(network_profile_cache_path) as f:
+            json.dump(cache, f)
+    except OSError as e:
+        logger.info('Could not save network profile cache: %s', e)
+
+def _profile_details(output):
+    """ Dictionary of the settings in nmcli -t output """
+    return dict(line.split(':', 1) for line in output.splitlines() if ':' in line)
+
+def _profile_matches(details, apn, username, password):
+    #nmcli shows settings that aren't set as empty
+    return (details.get('gsm.apn') == apn and details.get('gsm.username', '') == (username or '')
+            and details.get('gsm.password', '') == (password or ''))
+
+def _cached_profile_ok(uuid, apn, username, password):
+    """ Check the cached profile still exists with the same settings, in a single nmcli call """
+    result = run(['nmcli', '--show-secrets', '-t', '-f', 'gsm.apn,gsm.username,gsm.password', 'connection', 'show', uuid], timeout=command_timeout)
+    return result.ok and _profile_matches(_profile_details(result.output), apn, username, password)
+
+def _find_profile(apn, username, password):
+    """ Look through every GSM profile for one with these settings and return its UUID, or None """
+    # List existing GSM connections and grab their UUIDs
+    result = run(['nmcli', '-t', '-f', 'TYPE,UUID', 'connection', 'show'], timeout=command_timeout)
+    if not result.ok:
+        raise subprocess.CalledProcessError(result.returncode, result.args, result.output)
+    connections_output = result.output.strip()
+    gsm_uuids = [line.split(':')[1] for line in connections_output.split('\n') if line.startswith('gsm')]
+
+    # Fetch details of every GSM connection at the same time
+    details_results = run_many([['nmcli', '--show-secrets', '-t', 'connection', 'show', uuid] for uuid in gsm_uuids], timeout=command_timeout)
+
+    # Check each GSM connection for the specified APN, username, and password
+    for uuid, details_result in zip(gsm_uuids, details_results):
+        if details_result.ok and _profile_matches(_profile_details(details_result.output), apn, username, password):
+            return uuid
+    return None
+
+def _add_profile(name, apn, username, password):
+    """ Add a GSM profile and return its UUID """
+    add_command = ['nmcli', 'connection', 'add', 'type', 'gsm', 'con-name', name, 'gsm.apn', apn] 
+    if username is not None and username != "":
+        add_command.append('gsm.username')
+        add_command.append(username)
+    if password is not None and password != "":
+        add_command.append('gsm.password')
+        add_command.append(password)
+
+    result = run(add_command, timeout=command_timeout)
+    if not result.ok:
+        raise subprocess.CalledProcessError(result.returncode, result.args, result.output)
+    logger.info("New connection added with name: %s", name)
+
+    #nmcli prints "Connection 'name' (uuid) successfully added."
+    match = re.search(r'\(([0-9a-fA-F-]{36})\)', result.output)
+    if match:
+        return match.group(1)
+    result = run(['nmcli', '-g', 'connection.uuid', 'connection', 'show', name], timeout=command_timeout)
+    return result.output.strip() or None
+
+def activate_network_profile(uuid):
+    """ Bring a profile up in the background. Returns a Future of the nmcli CommandResult """
+    logger.info('Activating network profile %s', uuid)
+    return start(['nmcli', 'connection', 'up', 'uuid', uuid], timeout=network_activation_timeout)
+
+def add_network_profile(name, apn, username, password, activate=False):
+    """
+    Add a new GSM connection profile to NetworkManager if there isn't already one with the same apn, username and password.
+
+    The profile's UUID is cached against a fingerprint of those settings. Later boots only check that the cached
+    profile is still there and unchanged, with one nmcli call, instead of going through every GSM profile.
+    With activate the profile is brought up in the background straight away.
+
+    Returns:
+        The UUID of the profile, or None if it couldn't be found or added
+    """
+    fingerprint = network_fingerprint(apn, username, password)
+    cache = _load_profile_cache()
+    uuid = cache.get(fingerprint)
+
     try:
-        # List existing GSM connections and grab their UUIDs
-        result = subprocess.run(['nmcli', '-t', '-f', 'TYPE,UUID', 'connection', 'show'], stdout=subprocess.PIPE, check=True)
-        connections_output = result.stdout.decode().strip()
-        gsm_uuids = [line.split(':')[1] for line in connections_output.split('\n') if line.startswith('gsm')]
- 
-        # Check each GSM connection for the specified APN, username, and password
-        exists = False
-        for uuid in gsm_uuids:
-            # Fetch details of each GSM connection
-            details_result = subprocess.run(['nmcli', '--show-secrets', '-t', 'connection', 'show', uuid], stdout=subprocess.PIPE, check=True)
-            details_output = details_result.stdout.decode()
-        
-            # Build dictionary of the connection details
-            details = dict(line.split(':', 1) for line in details_output.splitlines() if ':' in line)
-            if details.get('gsm.apn') == apn and details.get('gsm.username') == username and details.get('gsm.password') == password:
-                exists = True
+        if uuid is not None and not _cached_profile_ok(uuid, apn, username, password):
+            logger.info("Cached connection %s has gone or changed, looking for another", uuid)
+            uuid = None
+
+        if uuid is None:
+            uuid = _find_profile(apn, username, password)
+            if uuid is not None:
                 logger.info("Skipping: connection with these details already exists.")
-                break
-    
+
         # If the connection does not exist, add it using the provided name
-        if not exists:
-            add_command = ['nmcli', 'connection', 'add', 'type', 'gsm', 'con-name', name, 'gsm.apn', apn] 
-            if username is not None and username != "":
-                add_command.append('gsm.username')
-                add_command.append(username)
-            if password is not None and password != "":
-                add_command.append('gsm.password')
-                add_command.append(password)
-        
-            if subprocess.run(add_command, check=True):
-                logger.info("New connection added with name: %s", name)
-                
+        if uuid is None:
+            uuid = _add_profile(name, apn, username, password)
+
     except subprocess.CalledProcessError as e:
         logger.info("Failed to add new connection: %s", e)
+        return None
+
+    if uuid is not None and cache.get(fingerprint) != uuid:
+        cache[fingerprint] = uuid
+        _save_profile_cache(cache)
+
+    if activate and uuid is not None:
+        activate_network_profile(uuid)
+
+    return uuid
+
+def provision_network(credentials_path, activate=True):
+    """ Make sure the mobile_network profile in the credentials file is in NetworkManager, and bring it up if activate """
+    with open(credentials_path) as f:
+        network = json.load(f)['mobile_network']
+    return add_network_profile(network_profile_name, network['hostname'], network.get('username'), network.get('password'), activate)
 
 def discover_serial():
 
@@ -181,7 +406,7 @@ def discover_serial():
 
     return cpu_serial
 
-#Not currently used, but could be used for telemetry file in the future
+#Used for the telemetry file
 def get_sys_uptime():
     """
     Get system uptime in seconds
@@ -196,83 +421,343 @@ def get_sys_uptime():
 Framework from BUGG, but heavily modified
 """
 
-#Sync to cloud
-def server_sync(cloud_dir, credentials_path, modem):
-    modem.power_on()
-    GLOBAL_is_connected = wait_for_connection(connection_retries)
+def connect(modem, credentials_path=None):
+    """
+    Power on the modem and wait for an internet connection.
+    If credentials_path is given, the mobile network profile in it is provisioned and brought up straight away.
+    Starts updating the time from the internet in the background if a connection was made.
 
-    if GLOBAL_is_connected:
+    Returns:
+        True if connected, False otherwise
+    """
+    with span('modem_power_on'):
+        modem.power_on()
+
+    if credentials_path is not None and provision_network_profile:
+        with span('network_profile'):
+            try:
+                provision_network(credentials_path)
+            except Exception as e:
+                logger.info('Could not provision the network profile: {}'.format(str(e)))
+    with span('connection_wait') as record:
+        is_connected = wait_for_connection(connection_retries)
+        record['connected'] = is_connected
+
+    if is_connected:
         update_time()
 
-        logger.info('Started upload to gc cloud dir {} at {}'.format(dt.datetime.utcnow(), cloud_dir))
-        Log.rotate_log()
+    return is_connected
+
+def find_usb_dir():
+    """ Return the first of usb_dirs that is mounted, or None if there is no USB """
+    return next((d for d in usb_dirs if os.path.isdir(d)), None)
+
+def get_journal():
+    """ Return the resumable upload journal, or None if resumable uploads are turned off """
+    if resumable_uploads:
+        return UploadJournal(upload_journal_path)
+    return None
+
+def get_index(usb_dir):
+    """ Open the upload index on the USB, adopting any files already on it the first time it's created """
+    index = UploadIndex(os.path.join(usb_dir, upload_index_name))
+    if index.created:
+        #Recordings are indexed as FLACs once they're converted, so wav files are left out
+        index.scan(usb_dir, skip_suffixes=('.wav',))
+    return index
+
+def telemetry_files():
+    """ The telemetry file as a list, to go up with the logs, or an empty list if there isn't one """
+    from .telemetry import TELEMETRY_PATH
+
+    return [TELEMETRY_PATH] if collect_telemetry and os.path.exists(TELEMETRY_PATH) else []
+
+def record_telemetry(modem, usb_dir=None, wav_dir=None):
+    """ Append this wake's telemetry snapshot, while the modem is still on. Does nothing if collect_telemetry is off """
+    if not collect_telemetry:
+        return
+    #Imported here, telemetry imports get_sys_uptime from this module
+    from .telemetry import record_snapshot
+
+    with span('telemetry'):
+        index = None
+        try:
+            if usb_dir and use_upload_index:
+                index = get_index(usb_dir)
+        except Exception as e:
+            logger.info('Could not open the upload index for telemetry: {}'.format(str(e)))
+
+        record_snapshot(modem, usb_dir, wav_dir, index)
+        if index is not None:
+            index.close()
+
+def get_bucket(credentials_path):
+    """ Return the device's GCS bucket using the service account in the credentials file """
+    from google.cloud import storage
+
+    #Get credentials from credentials json file
+    client = storage.Client.from_service_account_json(credentials_path)
+
+    #Find the right GCS bucket
+    with open(credentials_path) as f:
+        device_conf = json.load(f)['device']
+    gcs_bucket_name = device_conf['gcs_bucket_name']
+    return client.bucket(gcs_bucket_name)
+
+def upload_file(bucket, local_path, usb_dir, cloud_dir, archive_dir, journal=None, md5=None, progress=None):
+    """
+    Upload a single file and move it to the archive dir, if there is one.
+    If a journal is given the file is sent as a resumable upload in upload_chunk_size chunks.
+    md5 (or the one in the file's checksum sidecar) is sent with the upload so GCS checks what it received.
+    progress, if given, is called with the number of bytes sent as each chunk (or the whole file) goes through.
+    If the file did not upload successfully an Exception will be thrown, and the file is left where it is.
+    """
+    #Create remote path relative to USB and join it with the cloud dir
+    relative_path = os.path.relpath(local_path, usb_dir)
+    remote_path = os.path.join(cloud_dir, relative_path)
+    logger.info('Uploading {} to {}'.format(local_path, remote_path))
+
+    if md5 is None:
+        md5 = read_checksum(local_path)
+
+    #Upload files
+    size = os.path.getsize(local_path)
+    with span('upload', file=relative_path, bytes=size):
+        if journal is not None:
+            resumable_upload(bucket.client._http, bucket.name, local_path, remote_path, journal, upload_chunk_size, md5, progress)
+        else:
+            upload_f = bucket.blob(remote_path)
+            if md5:
+                upload_f.md5_hash = md5
+            upload_f.upload_from_filename(filename=local_path)
+            if progress is not None:
+                progress(size)
+    remove_checksum(local_path)
+
+    if archive_dir is None:
+        logger.info('Upload complete for {}'.format(local_path))
+        return
+
+    #Create archive path
+    archived_path = os.path.join(archive_dir, relative_path)
+    os.makedirs(os.path.dirname(archived_path), exist_ok=True)
+
+    #Move to archive instead of deleting
+    shutil.move(local_path, archived_path)
+    logger.info('Upload complete. Moved {} to archive'.format(local_path))
+
+def upload_files(bucket, local_paths, usb_dir, cloud_dir, archive_dir, workers=None, journal=None, index=None, scheduler=None):
+    """
+    Upload files on a bounded pool of threads sharing one bucket (and so one client and HTTP session).
+    local_paths can be any iterable, files are submitted as workers become free so it can be fed from a queue.
+    Each file is only archived, or marked uploaded in the index, once its own upload has finished without an exception.
+    If a scheduler is given, files that aren't expected to finish before its deadline are skipped.
+
+    Returns:
+        A dict with a list of 'uploaded' paths, a 'failed' dict of path to error message
+        and a list of 'skipped' paths that were left for the next upload slot
+    """
+    if workers is None:
+        workers = upload_workers
+
+    results = {'uploaded': [], 'failed': {}, 'skipped': []}
+    in_flight = {}
+    lock = threading.Condition()
+
+    def in_flight_bytes():
+        with lock:
+            return sum(s for (_, s) in in_flight.values())
+
+    def finish(future):
+        #Runs on the upload thread as soon as its upload is done, so the scheduler and index are up to date
+        #even while the loop below is blocked waiting for the next file (e.g. on the pipeline's queue)
+        with lock:
+            local_path, size = in_flight[future]
+        try:
+            if scheduler is not None:
+                scheduler.finished()
+            try:
+                future.result()
+            except Exception as e:
+                logger.info('Exception caught in gcs_server_sync: {}'.format(str(e)))
+                with lock:
+                    results['failed'][local_path] = str(e)
+                if index is not None:
+                    index.mark_failed(local_path, str(e))
+                return
+
+            with lock:
+                results['uploaded'].append(local_path)
+            if index is not None:
+                index.mark_uploaded(local_path)
+                if delete_uploaded:
+                    #It's already uploaded, a file that can't be removed mustn't stop the rest of the queue
+                    try:
+                        os.remove(local_path)
+                    except OSError as e:
+                        logger.info('Could not remove uploaded file {}: {}'.format(local_path, str(e)))
+        finally:
+            with lock:
+                del in_flight[future]
+                lock.notify_all()
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for local_path in local_paths:
+            #Wait for a free worker, so each file is checked against the latest throughput estimate
+            with lock:
+                lock.wait_for(lambda: len(in_flight) < workers)
+
+            try:
+                size = os.path.getsize(local_path)
+            except OSError:
+                size = 0
+
+            if scheduler is not None:
+                fits = scheduler.can_start(size, in_flight_bytes())
+                while not fits and in_flight and not scheduler.measured():
+                    #The link is still being measured, don't turn the file down on the initial guess
+                    with lock:
+                        lock.wait(timeout=1)
+                    fits = scheduler.can_start(size, in_flight_bytes())
+
+                if not fits:
+                    logger.info('Not enough time left to upload {}, leaving it for next time'.format(local_path))
+                    results['skipped'].append(local_path)
+                    continue
+                scheduler.started()
+
+            #The index already has the MD5, so it isn't worked out again for the upload
+            entry = index.get(local_path) if index is not None else None
+            md5 = entry['md5'] if entry else None
+
+            progress = scheduler.progress if scheduler is not None else None
+            future = executor.submit(upload_file, bucket, local_path, usb_dir, cloud_dir, archive_dir, journal, md5, progress)
+            with lock:
+                in_flight[future] = (local_path, size)
+            future.add_done_callback(finish)
+
+    #Leaving the with block waited for every upload, and so for every finish()
+
+    logger.info('Uploaded {} files, {} failed, {} skipped'.format(len(results['uploaded']), len(results['failed']), len(results['skipped'])))
+    return results
+
+def bundle_files(local_paths, usb_dir, index=None):
+    """
+    Replace the small files in local_paths with bundles in usb_dir/bundles.
+    The bundled files are removed from the USB, the bundle holds them until it's uploaded.
+
+    Returns:
+        The new list of paths to upload
+    """
+    #Summaries get bundles of their own, so they still go first under the 'priority' upload policy
+    summaries = [path for path in local_paths if path.endswith(SUMMARY_SUFFIX)]
+    others = [path for path in local_paths if not path.endswith(SUMMARY_SUFFIX)]
+    dest_dir = os.path.join(usb_dir, 'bundles')
+
+    summary_bundles, summaries = make_bundles(summaries, usb_dir, dest_dir, bundle_threshold, bundle_target_size, prefix='summaries')
+    bundles, others = make_bundles(others, usb_dir, dest_dir, bundle_threshold, bundle_target_size)
+    bundles = summary_bundles + bundles
+    others = summaries + others
+
+    for bundle_path, members in bundles:
+        if index is not None:
+            index.add(bundle_path)
+            index.mark_bundled(members)
+        for member in members:
+            os.remove(member)
+            remove_checksum(member)
+
+    return [os.path.abspath(bundle_path) for (bundle_path, _) in bundles] + others
+
+def upload_usb(bucket, usb_dir, cloud_dir, archive_dir, workers=None, journal=None, scheduler=None):
+    """ Upload every file on the USB that isn't already archived, then delete the archive """
+    #Find the local files that need uploading
+    local_paths = []
+    for root, _, files in os.walk(usb_dir):
+        for local_f in files:
+            local_path = os.path.join(root, local_f)
+
+            #Skip hidden files, the checksum sidecars and the upload index
+            if local_f.startswith('.'):
+                continue
+
+            #Skip files in archive dir
+            if local_path.startswith(archive_dir + os.sep):
+                continue
+
+            local_paths.append(local_path)
+
+    if bundle_small_files:
+        local_paths = bundle_files(local_paths, usb_dir)
+
+    if scheduler is not None:
+        local_paths = scheduler.order(local_paths)
+
+    results = upload_files(bucket, local_paths, usb_dir, cloud_dir, archive_dir, workers=workers, journal=journal, scheduler=scheduler)
+
+    #Delete files after they're successfully sent
+    try:
+        if os.path.exists(archive_dir):
+            shutil.rmtree(archive_dir)
+            logger.info('Succesfully deleted archive_dir')
+
+    except Exception as e:
+        logger.info('Exception caught in archive cleanup in gcs_server_sync: {}'.format(str(e)))
+
+    return results
+
+def upload_indexed(bucket, index, usb_dir, cloud_dir, new_files=(), workers=None, journal=None, scheduler=None):
+    """ Add new_files to the index and upload everything it has pending """
+    for local_path in new_files:
+        index.add(local_path)
+
+    local_paths = index.pending()
+    if bundle_small_files:
+        local_paths = bundle_files(local_paths, usb_dir, index)
+
+    if scheduler is not None:
+        local_paths = scheduler.order(local_paths)
+
+    return upload_files(bucket, local_paths, usb_dir, cloud_dir, None, workers=workers, journal=journal, index=index, scheduler=scheduler)
+
+#Sync to cloud
+def server_sync(cloud_dir, credentials_path, modem, log=None, new_files=()):
+    """
+    Connect and upload the files on the USB.
+    new_files are files created this boot (e.g. converted FLACs) that need adding to the upload index.
+    Uploads are ordered and cut off by an UploadScheduler so the modem is on for at most upload_time_budget.
+    """
+    scheduler = UploadScheduler(upload_time_budget, upload_policy)
+    GLOBAL_is_connected = connect(modem, credentials_path)
+    usb_dir = None
+
+    if GLOBAL_is_connected:
+        logger.info('Started upload to gc cloud dir {} at {}'.format(cloud_dir, dt.datetime.utcnow()))
+        if log is not None:
+            log.rotate_log()
 
         try:
             #Detect mounted USB 
-            usb_dirs = ['/mnt/x'] #Can add more common paths if unsure where it is mounted
-            usb_dir = next((d for d in usb_dirs if os.patg.isdir(d)), None)
+            usb_dir = find_usb_dir()
 
             if not usb_dir:
                 logger.error('No USB detected')
                 return
-            
-            #Create archive dir on USB
-            archive_dir = os.path.join(usb_dir, 'uploaded')
-            os.makedirs(archive_dir, exist_ok=True)
 
-            #Get credentials from credentials json file
-            client = storage.client.from_service_account_json(credentials_path)
+            #Finished logs and the telemetry from earlier wakes go up with everything else, bundled into one archive
+            if log is not None:
+                new_files = list(new_files) + log.move_archived_to_dir(usb_dir, extra_files=telemetry_files())
 
-            #Find the right GCS bucket
-            device_conf = json.load(open(credentials_path))['device']
-            gcs_bucket_name = device_conf['gcs_bucket_name']
-            bucket = client.bucket(gcs_bucket_name)
+            bucket = get_bucket(credentials_path)
 
-            # Loop through local files, uploading them to the server
-            for root, _, files in os.walk(usb_dir):
-                for local_f in files:
-                    local_path = os.path.join(root, local_f)
+            if use_upload_index:
+                upload_indexed(bucket, get_index(usb_dir), usb_dir, cloud_dir, new_files, journal=get_journal(), scheduler=scheduler)
+            else:
+                #Create archive dir on USB
+                archive_dir = os.path.join(usb_dir, 'uploaded')
+                os.makedirs(archive_dir, exist_ok=True)
 
-                    #Skip files in archive dir
-                    if archive_dir in local_path:
-                        continue
-
-                    try:
-                        #Create remote path relative to USB and join it with the cloud dir
-                        remote_path = os.path.relpath(local_path, usb_dir)
-                        remote_path = os.path.join(cloud_dir, remote_path)
-                        logger.info('Uploading {} to {}'.format(local_path, remote_path))
-
-                        #Upload files
-                        upload_f = bucket.blob(remote_path)
-                        upload_f.upload_from_filename(filename=local_path)
-
-                        #Create archive path
-                        relative_path = os.path.relpath(local_path, usb_dirs)
-                        archived_path = os.path.join(archive_dir, relative_path)
-                        os.makedirs(os.path.dirname(archived_path), exist_ok=True)
-
-                        #Move to archive instead of deleting
-                        shutil.move(local_path, archived_path)
-                        logger.info('Moved {} to archive'.format(local_path))
-
-                        # If the file did not upload successfully an Exception will be thrown
-                        # by upload_from_filename, so if we're here it's safe to delete the local file
-                        logger.info('Upload complete. Deleting local file at {}'.format(local_path))
-                        os.remove(local_path)   
-
-                    except Exception as e:
-                        logger.info('Exception caught in gcs_server_sync: {}'.format(str(e)))
-                        continue
-
-                    #Delete files after they're successfully sent
-                    try:
-                        if os.path.exists(archive_dir):
-                            shutil.rmtree(archive_dir)
-                            logger.info('Succesfully deleted archive_dir')
-                        
-                    except Exception as e:
-                        logger.info('Exception caught in archive cleanup in gcs_server_sync: {}'.format(str(e)))
+                upload_usb(bucket, usb_dir, cloud_dir, archive_dir, journal=get_journal(), scheduler=scheduler)
 
         except Exception as e:
             logger.info('Exception caught in gcs_server_sync: {}'.format(str(e)))
@@ -280,21 +765,254 @@ def server_sync(cloud_dir, credentials_path, modem):
     else: 
         logger.info('No internet connection available, not uploading')
 
+    wait_for_time_sync()
+
+    #Recorded with or without a connection, it goes up on the next sync
+    record_telemetry(modem, usb_dir or find_usb_dir())
+
     logger.info('Diabling modem and RPi until next upload slot')
     modem.power_off()
 
+def pipeline_sync(wav_dir, cloud_dir, credentials_path, modem, log=None):
+    """
+    Convert and upload at the same time instead of one after the other.
+
+    The modem is powered on and waits for a connection in a background thread while the backlog
+    is converted. Each finished FLAC is put on a queue which an uploader thread starts working
+    through as soon as the link is up. Anything else left on the USB is uploaded once conversion is done.
+    The same UploadScheduler budget as server_sync applies, counted from when this is called.
+    The modem is powered off as soon as it isn't needed, if the link fails or the budget runs out,
+    and the conversion carries on without it.
+    """
+    scheduler = UploadScheduler(upload_time_budget, upload_policy)
+    link_up = threading.Event()
+    link = {'connected': False, 'log_files': [], 'converted': False, 'powered_off': False}
+    upload_queue = queue.Queue()
+    power_lock = threading.Lock()
+
+    #Detect mounted USB and create archive dir on it if the upload index isn't used
+    usb_dir = find_usb_dir()
+    archive_dir = None
+    if not usb_dir:
+        logger.error('No USB detected')
+    elif not use_upload_index:
+        archive_dir = os.path.join(usb_dir, 'uploaded')
+        os.makedirs(archive_dir, exist_ok=True)
+
+    def bring_up_link():
+        try:
+            link['connected'] = connect(modem, credentials_path)
+            if link['connected'] and log is not None:
+                log.rotate_log()
+                if usb_dir:
+                    link['log_files'] = log.move_archived_to_dir(usb_dir, extra_files=telemetry_files())
+        except Exception as e:
+            logger.info('Exception caught while connecting in pipeline_sync: {}'.format(str(e)))
+        finally:
+            link_up.set()
+
+    def power_down():
+        #Called by the uploader once it's done with the link, and again after conversion in case it didn't get that far
+        with power_lock:
+            if link['powered_off']:
+                return
+            link['powered_off'] = True
+
+            wait_for_time_sync()
+
+            #Taken while the modem is still on, the wav backlog is whatever is left to convert
+            record_telemetry(modem, usb_dir, wav_dir)
+
+            logger.info('Diabling modem and RPi until next upload slot')
+            modem.power_off()
+
+    def queued():
+        #Files as they're converted, until conversion is done or there's no time left to upload them
+        while scheduler.remaining() > 0:
+            try:
+                local_path = upload_queue.get(timeout=1)
+            except queue.Empty:
+                continue
+            if local_path is None:
+                link['converted'] = True
+                return
+            yield local_path
+
+    def indexed(index, local_paths):
+        #Add each file to the index just before it's handed to the uploader
+        for local_path in local_paths:
+            index.add(local_path)
+            yield os.path.abspath(local_path)
+
+    def uploader():
+        link_up.wait()
+        bucket = None
+        journal = None
+        index = None
+
+        if not link['connected']:
+            logger.info('No internet connection available, not uploading')
+        elif usb_dir:
+            logger.info('Started upload to gc cloud dir {} at {}'.format(cloud_dir, dt.datetime.utcnow()))
+            try:
+                bucket = get_bucket(credentials_path)
+                journal = get_journal()
+            except Exception as e:
+                logger.info('Exception caught in pipeline_sync: {}'.format(str(e)))
+
+        #Upload files as they come off the queue until conversion is done, then the rest of the USB
+        try:
+            if bucket is not None and use_upload_index:
+                index = get_index(usb_dir)
+                upload_files(bucket, indexed(index, queued()), usb_dir, cloud_dir, None, journal=journal, index=index, scheduler=scheduler)
+                upload_indexed(bucket, index, usb_dir, cloud_dir, link['log_files'], journal=journal, scheduler=scheduler)
+            elif bucket is not None:
+                upload_files(bucket, queued(), usb_dir, cloud_dir, archive_dir, journal=journal, scheduler=scheduler)
+                upload_usb(bucket, usb_dir, cloud_dir, archive_dir, journal=journal, scheduler=scheduler)
+        finally:
+            power_down()
+
+        #Anything converted from now on stays on the USB for next time, but still goes in the index
+        if not link['converted']:
+            for local_path in iter(upload_queue.get, None):
+                if index is not None:
+                    index.add(local_path)
+
+    link_thread = threading.Thread(target=bring_up_link, daemon=True)
+    upload_thread = threading.Thread(target=uploader, daemon=True)
+    link_thread.start()
+    upload_thread.start()
+
+    try:
+        convert_directory(wav_dir, on_converted=upload_queue.put)
+    finally:
+        upload_queue.put(None)
+
+    link_thread.join()
+    upload_thread.join()
+
+    power_down()
+
 """
 Functions fully written, not from BUGG
 """
 
 #Compress files
-def wavtoflac(inputfile):
+def wavtoflac(inputfile, stream=True, blocksize=None, verify=None, profile='default', activity=None, summaries=None, stats=None):
+    """
+    Convert a WAV file to FLAC and delete the WAV file afterwards
+
+    With stream=True the file is read and encoded blocksize frames at a time into one reused
+    int16 buffer, so memory use is bounded by the block size instead of the length of the recording.
+    stream=False reads the whole file into memory at once.
+
+    profile is one of encoding.PROFILES and sets the compression level, and the read block size if blocksize isn't given.
+    Profiles that reduce the bit depth or sample rate are only applied when streaming.
+
+    activity ('trim' or 'drop', activity_detection by default) runs an ActivityGate over the samples while
+    streaming and writes the kept time ranges to <name>.activity.json. If there was no activity at all
+    the FLAC is deleted along with the WAV and None is returned.
+
+    summaries (acoustic_summaries by default) writes <name>.summary.npz from the same read while streaming.
+    It's written even if the audio itself is dropped.
+
+    While streaming, the MD5 of the samples is taken as they're encoded. With verify (verify_flac by default)
+    the FLAC is decoded again and the WAV is only deleted if it gives back the same samples, otherwise the FLAC
+    is deleted and a ValueError raised. The MD5 of the FLAC itself is taken while it's read for that check and
+    saved in its checksum sidecar, for the upload index and GCS to use without reading the file again.
+
+    If stats is a dict, 'encode_cpu_s' is set in it to the CPU time spent on the encoding alone (including any
+    bit depth reduction or decimation), without the reading, verification, summary or activity detection.
+    """
+    import soundfile as sf
+    import numpy as np
+
+    settings = get_profile(profile)
+    if blocksize is None:
+        blocksize = settings.get('blocksize') or flac_blocksize
+    if verify is None:
+        verify = verify_flac
+    if activity is None:
+        activity = activity_detection
+    if summaries is None:
+        summaries = acoustic_summaries
+
+    #Only passed if set, older soundfile versions don't have compression_level
+    options = {}
+    if settings.get('compression_level') is not None:
+        options['compression_level'] = settings['compression_level']
+
     #Handling the name changing
     inputname, _ = os.path.splitext(inputfile)
     outputname = inputname + ".flac"
 
-    data, samplerate = sf.read(inputfile) #Read WAV file
-    sf.write(outputname, data, samplerate, subtype='FLAC') #Copies the file into a FLAC file
+    if stream:
+        bit_depth = settings.get('bit_depth')
+        factor = settings.get('decimate') or 1
+        pcm_md5 = hashlib.md5()
+        frames = 0
+        encode_cpu = 0.0
+        with sf.SoundFile(inputfile) as wav:
+            if wav.samplerate % factor:
+                raise ValueError(f'Can not decimate {inputfile} at {wav.samplerate} Hz by {factor}')
+            decimator = Decimator(factor, wav.channels) if factor > 1 else None
+            gate = ActivityGate(wav.samplerate, wav.channels, trim=(activity == 'trim')) if activity else None
+            summary = SummaryAccumulator(wav.samplerate, wav.channels) if summaries else None
+
+            flac = sf.SoundFile(outputname, 'w', samplerate=wav.samplerate // factor, channels=wav.channels, format='FLAC', subtype='PCM_16', **options)
+            try:
+                def encode(block):
+                    nonlocal frames, encode_cpu
+                    start = time.thread_time()
+                    if bit_depth:
+                        reduce_bit_depth(block, bit_depth)
+                    if decimator is not None:
+                        block = decimator.process(block)
+                    flac.write(block)
+                    encode_cpu += time.thread_time() - start
+                    pcm_md5.update(block)
+                    frames += len(block)
+
+                #Reused for every block, AudioMoth records 16 bit PCM so there's no need to upcast to float64
+                buffer = np.empty((blocksize, wav.channels), dtype='int16')
+                for block in wav.blocks(dtype='int16', always_2d=True, out=buffer):
+                    if summary is not None:
+                        summary.feed(block)
+                    for kept in (gate.feed(block) if gate is not None else [block]):
+                        encode(kept)
+                if gate is not None:
+                    for kept in gate.finish():
+                        encode(kept)
+            finally:
+                #The last frames are encoded when the file is closed
+                start = time.thread_time()
+                flac.close()
+                encode_cpu += time.thread_time() - start
+
+        if summary is not None:
+            summary.write(summary_path(inputfile))
+
+        if gate is not None:
+            gate.write_index(activity_index_path(inputfile), os.path.basename(inputfile))
+            if not gate.ranges:
+                os.remove(outputname)
+                os.remove(inputfile)
+                print(f"No activity in {inputfile}, deleted it")
+                return None
+
+        if verify:
+            flac_md5 = _verify_flac(outputname, pcm_md5.digest(), frames, blocksize)
+        else:
+            flac_md5 = file_md5(outputname)
+        write_checksum(outputname, flac_md5)
+    else:
+        data, samplerate = sf.read(inputfile) #Read WAV file
+        start = time.thread_time()
+        sf.write(outputname, data, samplerate, format='FLAC', subtype='PCM_16', **options) #Copies the file into a FLAC file
+        encode_cpu = time.thread_time() - start
+
+    if stats is not None:
+        stats['encode_cpu_s'] = round(encode_cpu, 3)
 
     #Delete wav file after compression
     if os.path.exists(outputname):  #Ensure the FLAC file was successfully created
@@ -303,7 +1021,91 @@ def wavtoflac(inputfile):
 
     return outputname
 
-def convert_directory(dir):
+def _verify_flac(outputname, pcm_digest, frames, blocksize):
+    """
+    Decode a FLAC and check it has frames samples with the MD5 pcm_digest, deleting it and raising a ValueError if not.
+    Returns the base64 MD5 of the FLAC file, taken from the same read as the decode
+    """
+    import soundfile as sf
+    import numpy as np
+
+    pcm_md5 = hashlib.md5()
+    decoded = 0
+    with HashingReader(outputname) as f:
+        with sf.SoundFile(f) as flac:
+            buffer = np.empty((blocksize, flac.channels), dtype='int16')
+            for block in flac.blocks(dtype='int16', always_2d=True, out=buffer):
+                pcm_md5.update(block)
+                decoded += len(block)
+        flac_md5 = f.b64digest()
+
+    if decoded != frames or pcm_md5.digest() != pcm_digest:
+        os.remove(outputname)
+        raise ValueError(f'{outputname} does not decode to the same samples as the WAV ({decoded} of {frames} frames), keeping the WAV')
+
+    #Only if the decoder didn't read the file straight through
+    if flac_md5 is None:
+        flac_md5 = file_md5(outputname)
+    return flac_md5
+
+def _convert_worker(inputfile, profile, activity, summaries):
+    """
+    Convert a single file, runs inside a worker process.
+    Returns (inputfile, outputfile, error, timing, extra_files) so that one bad file doesn't stop the rest of the backlog.
+    The timing span is returned rather than recorded, since a worker process can't add to the parent's timings.
+    extra_files are the other files written for the recording, its summary and activity index
+    """
+    record = {}
+    try:
+        with Timings().span('convert', file=os.path.basename(inputfile), bytes=os.path.getsize(inputfile), profile=profile, activity=activity) as record:
+            outputfile = wavtoflac(inputfile, profile=profile, activity=activity, summaries=summaries, stats=record)
+            record['output_bytes'] = os.path.getsize(outputfile) if outputfile else 0
+        extra_files = ([summary_path(inputfile)] if summaries else []) + ([activity_index_path(inputfile)] if activity else [])
+        return inputfile, outputfile, None, record, extra_files
+    except Exception as e:
+        return inputfile, None, str(e), record, []
+
+def _report_conversion(inputfile, outputfile, error, timing, extra_files, on_converted=None):
+    if timing:
+        timings.add(timing)
+    if error is not None:
+        logger.error('Failed to convert %s: %s', inputfile, error)
+        return
+
+    if outputfile is not None:
+        print(f"Converted: {inputfile} to {outputfile}")
+    if on_converted is not None:
+        #The summary first, so it's uploaded ahead of the audio in pipeline mode
+        for path in extra_files + [outputfile]:
+            if path is not None:
+                on_converted(path)
+
+def convert_directory(dir, workers=None, memory_limit=None, on_converted=None, profile=None, rssi_dbm=None):
+    """
+    Convert all but the newest wav file in dir to FLAC, oldest first.
+
+    Files are spread over a pool of worker processes. The number of workers is capped so that
+    their combined memory stays below memory_limit.
+    on_converted is called with the path of each FLAC, and its summary and activity index if those
+    are turned on, as soon as they have been written.
+
+    profile defaults to flac_profile. With 'auto' the profile is chosen from the measured speed of each one,
+    the size of the backlog and rssi_dbm. The modem is usually still off while converting, so rssi_dbm
+    defaults to the signal strength in the latest telemetry snapshot.
+
+    Returns:
+        A list of (inputfile, outputfile, error) tuples in the order the files were queued.
+        Each conversion is also recorded as a 'convert' timing span.
+        outputfile is None and error holds the message if a file failed to convert,
+        or outputfile and error are both None if the recording had no activity and was dropped.
+    """
+    if workers is None:
+        workers = conversion_workers
+    if memory_limit is None:
+        memory_limit = conversion_memory_limit
+    if profile is None:
+        profile = flac_profile
+
     #Puts all the wav files in a list, keeping their metadata
     wav_files = []
     for file in os.listdir(dir):
@@ -318,20 +1120,67 @@ def convert_directory(dir):
     #Returns if there is no wav files in directory
     if not wav_files:
         print("No wav files")
-        return
+        return []
     
     #Sorts wav files by last modification time in ascending order
     wav_files.sort()
 
     #Creates new list without the latest file
     files_to_convert = [path for (lastedit, path) in wav_files[:-1]]
+    if not files_to_convert:
+        return []
+
+    stats = load_stats(profile_stats_path)
+    if profile == 'auto':
+        if rssi_dbm is None:
+            #Imported here, telemetry imports get_sys_uptime from this module
+            from .telemetry import last_rssi_dbm
+            rssi_dbm = last_rssi_dbm()
+        backlog_bytes = sum(os.path.getsize(path) for path in files_to_convert)
+        cpus = min(workers, len(files_to_convert), os.cpu_count() or 1)
+        profile = select_profile(stats, backlog_bytes, rssi_dbm, cpus, allow_lossy_profiles)
+
+    #Each worker holds one int16 block buffer (allowing for stereo) on top of its fixed overhead
+    blocksize = get_profile(profile).get('blocksize') or flac_blocksize
+    memory_per_worker = worker_memory_overhead + blocksize * 2 * 2
+    workers = max(1, min(workers, len(files_to_convert), memory_limit // memory_per_worker))
 
     #Converts the files to flac
-    for inputfile in files_to_convert:
-        outputfile = wavtoflac(inputfile)
-        print(f"Converted: {inputfile} to {outputfile}")
+    if workers == 1:
+        results = []
+        for inputfile in files_to_convert:
+            results.append(_convert_worker(inputfile, profile, activity_detection, acoustic_summaries))
+            _report_conversion(*results[-1], on_converted)
+    else:
+        #Workers are started fresh rather than forked, a fork would copy locks held by pipeline_sync's link and uploader threads
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+            futures = [executor.submit(_convert_worker, inputfile, profile, activity_detection, acoustic_summaries) for inputfile in files_to_convert]
+            for future in as_completed(futures):
+                _report_conversion(*future.result(), on_converted)
+            results = [future.result() for future in futures]
+
+    #Measure the profile for the next 'auto' choice, trimmed recordings would make its ratio look better than it is
+    for (_, outputfile, error, timing, _) in results:
+        if error is None and outputfile is not None and timing['activity'] != 'trim':
+            update_stats(stats, profile, timing['bytes'], timing['output_bytes'], timing['encode_cpu_s'])
+    save_stats(profile_stats_path, stats)
+
+    return [(inputfile, outputfile, error) for (inputfile, outputfile, error, _, _) in results]
+
+def shut_down(log=None, modem=None):
+    import RPi.GPIO as GPIO
+
+    #Make sure every queued log record is on disk first, the MCU may cut the power as soon as the pin goes high
+    if log is not None:
+        log.close()
+
+    #Turn off modem, the sync has normally done this already
+    if modem is not None:
+        try:
+            modem.power_off()
+        except Exception as e:
+            logger.info('Could not power off the modem: {}'.format(str(e)))
 
-def shut_down():
     GPIO.setmode(GPIO.BCM)
     GPIO.setup(Shutdown_GPIO_pin, GPIO.OUT)
 
@@ -342,8 +1191,5 @@ def shut_down():
     #Cleanup/reset GPIO Pins to default state
     GPIO.cleanup()
 
-    #Turn off modem
-    Modem.power_off()
-
     #Initiate safe shutdown
     subprocess.run(["sudo", "shutdown", "-h", "now"])